@@ -40,19 +40,34 @@ def train_model(
     patience: int = 20,       # ULTRA: patience 20
     augment: bool = True,     # ULTRA: augmentation
     mixup: bool = True,       # ULTRA: mixup
+    seed: int = 0,
+    checkpoint_every: int = 2000,  # steps between full-state checkpoints
+    resume: bool = False,     # continue from ./data/ultra_state.ckpt (e.g. after a timeout)
+    step_log: bool = False,   # per-step phase timings -> ./data/ultra_steps.jsonl (syncs the GPU)
 ) -> dict:
     """Train OMFK ensemble model - ULTRA settings matching train_master.sh."""
     import torch
     import torch.nn as nn
     import torch.optim as optim
-    from torch.utils.data import DataLoader
     import os
     import sys
     import random
     import numpy as np
     
     sys.path.insert(0, "./data")
-    from train import EnsembleModel, LayoutDataset, CLASSES
+    # train.py imports vocab.py, tokenized.py, instrument.py and generate_data.py: keep them in the volume too.
+    import itertools
+    from train import (
+        EnsembleModel,
+        TensorLayoutDataset,
+        make_loaders,
+        augment_ids,
+        save_checkpoint,
+        load_checkpoint,
+        restore_rng_state,
+        CLASSES,
+    )
+    from instrument import StepTimer, read_step_log, summarize
     
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"🚀 OMFK ULTRA Training")
@@ -66,8 +81,19 @@ def train_model(
         print(f"Files in ./data: {os.listdir('./data')}")
         return {"error": f"Data file not found: {data_path}"}
     
+    checkpoint_path = "./data/ultra_state.ckpt"
+    resume_state = None
+    if resume and os.path.exists(checkpoint_path):
+        resume_state = load_checkpoint(checkpoint_path)
+        seed = resume_state['seed']
+        print(f"♻️ Resuming from {checkpoint_path} (epoch {resume_state['epoch'] + 1}, batch {resume_state['step']})")
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    
     print(f"\n📊 Loading data from {data_path}...")
-    full_dataset = LayoutDataset(data_path, augment=augment)
+    # Tokenized once and cached in the volume, so reruns on the same CSV skip parsing.
+    full_dataset = TensorLayoutDataset.from_csv(data_path, cache_dir="./data/.token_cache")
     print(f"Total samples: {len(full_dataset):,}")
     
     train_size = int(0.9 * len(full_dataset))
@@ -75,32 +101,14 @@ def train_model(
     
     # Split indices, then create separate datasets
     indices = list(range(len(full_dataset)))
-    random.shuffle(indices)
+    random.Random(seed).shuffle(indices)
     train_indices = indices[:train_size]
     val_indices = indices[train_size:]
     
-    # Training with augmentation
-    train_dataset = LayoutDataset(data_path, augment=augment)
-    train_dataset.data = full_dataset.data.iloc[train_indices].reset_index(drop=True)
+    train_dataset = full_dataset.subset(train_indices)
+    val_dataset = full_dataset.subset(val_indices)
     
-    # Validation without augmentation
-    val_dataset = LayoutDataset(data_path, augment=False)
-    val_dataset.data = full_dataset.data.iloc[val_indices].reset_index(drop=True)
-    
-    train_loader = DataLoader(
-        train_dataset, 
-        batch_size=batch_size, 
-        shuffle=True, 
-        num_workers=4, 
-        pin_memory=True
-    )
-    val_loader = DataLoader(
-        val_dataset, 
-        batch_size=batch_size * 2, 
-        shuffle=False, 
-        num_workers=4, 
-        pin_memory=True
-    )
+    train_loader, val_loader = make_loaders(train_dataset, val_dataset, batch_size, pin_memory=True, seed=seed)
     
     print(f"Train: {len(train_dataset):,}, Val: {len(val_dataset):,}")
     print(f"\n⚙️ Config: epochs={epochs}, batch={batch_size}, lr={lr}, patience={patience}")
@@ -118,14 +126,56 @@ def train_model(
     
     best_val_acc = 0.0
     patience_counter = 0
+    start_epoch, start_step, global_step = 0, 0, 0
+    epoch_stats = (0, 0, 0)
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        best_val_acc = resume_state['best_val_acc']
+        patience_counter = resume_state['patience_counter']
+        start_epoch = epochs if resume_state['stopped'] else resume_state['epoch']
+        start_step = resume_state['step']
+        global_step = resume_state['global_step']
+        epoch_stats = resume_state['epoch_stats']
+        restore_rng_state(resume_state['rng'])
+    
+    def checkpoint(epoch, step, epoch_stats, stopped=False):
+        save_checkpoint(
+            checkpoint_path,
+            seed=seed,
+            epoch=epoch,
+            step=step,
+            global_step=global_step,
+            epoch_stats=epoch_stats,
+            model=model.state_dict(),
+            optimizer=optimizer.state_dict(),
+            scheduler=scheduler.state_dict(),
+            best_val_acc=best_val_acc,
+            patience_counter=patience_counter,
+            stopped=stopped,
+        )
+    
+    step_log_path = "./data/ultra_steps.jsonl" if step_log else None
+    timer = StepTimer(step_log_path, device)
     
     print(f"\n🏋️ Starting training...")
-    for epoch in range(epochs):
+    epoch = start_epoch - 1
+    for epoch in range(start_epoch, epochs):
         model.train()
-        total_loss, correct, total = 0, 0, 0
+        total_loss, correct, total = epoch_stats
+        epoch_stats = (0, 0, 0)
+        train_loader.sampler.set_epoch(epoch)
+        batches = itertools.islice(train_loader, start_step, None) if start_step else train_loader
         
-        for batch_idx, (inputs, labels) in enumerate(train_loader):
+        timer.start()
+        for batch_idx, (inputs, labels) in enumerate(batches, start=start_step):
+            timer.mark('data')
             inputs, labels = inputs.to(device), labels.to(device)
+            timer.mark('h2d')
+            if augment:
+                inputs = augment_ids(inputs)
+                timer.mark('augment')
             
             # Mixup
             if mixup and random.random() < 0.5:
@@ -139,20 +189,31 @@ def train_model(
             else:
                 outputs = model(inputs)
                 loss = criterion(outputs, labels)
+            timer.mark('forward')
             
             optimizer.zero_grad()
             loss.backward()
+            timer.mark('backward')
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
             optimizer.step()
+            timer.mark('optimizer')
             
             total_loss += loss.item()
             _, pred = outputs.max(1)
             total += labels.size(0)
             correct += (pred == labels).sum().item()
+            timer.mark('metrics')
             
             if batch_idx % 500 == 0 and batch_idx > 0:
                 print(f"  [{epoch+1}] Batch {batch_idx}/{len(train_loader)}, Loss: {loss.item():.4f}")
+            
+            global_step += 1
+            if checkpoint_every and global_step % checkpoint_every == 0:
+                checkpoint(epoch, batch_idx + 1, (total_loss, correct, total))
+                timer.mark('checkpoint')
+            timer.end_step(epoch, global_step, labels.size(0))
         
+        start_step = 0
         train_acc = 100 * correct / total
         
         # Validate
@@ -170,6 +231,7 @@ def train_model(
         
         print(f"Epoch {epoch+1}/{epochs} | Loss: {total_loss/len(train_loader):.4f} | Train: {train_acc:.2f}% | Val: {val_acc:.2f}%")
         
+        stop = False
         if val_acc > best_val_acc:
             best_val_acc = val_acc
             patience_counter = 0
@@ -177,13 +239,18 @@ def train_model(
             print(f"  ✅ New best! Saved model (Val: {val_acc:.2f}%)")
         else:
             patience_counter += 1
-            if patience_counter >= patience and epoch >= 20:
-                print(f"\n⏹️ Early stopping at epoch {epoch+1} (no improvement for {patience} epochs)")
-                break
+            stop = patience_counter >= patience and epoch >= 20
+        checkpoint(epoch + 1, 0, (0, 0, 0), stopped=stop)
+        if stop:
+            print(f"\n⏹️ Early stopping at epoch {epoch+1} (no improvement for {patience} epochs)")
+            break
     
     print(f"\n🎉 Training complete!")
     print(f"Best validation accuracy: {best_val_acc:.2f}%")
     print(f"Model saved to: ./data/model_ultra.pth")
+    timer.close()
+    if step_log_path:
+        summarize(read_step_log(step_log_path))
     
     return {
         "best_val_acc": best_val_acc,
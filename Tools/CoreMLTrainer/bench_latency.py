@@ -0,0 +1,299 @@
+"""CPU inference latency / throughput benchmark for every classifier architecture.
+
+For each model (v1, v2, transformer, ensemble: random weights, or --checkpoint files), variant
+(eager; traced: torch.jit.trace of the traceable graph export.py converts; fused: that graph
+in eager mode with scaled_dot_product_attention, transformer / ensemble only) and torch thread count
+(process pinned to that many cores) it measures batch-1 latency percentiles, the app's
+per-keystroke case, and samples/s at larger batches. Results go to a JSON file tagged with
+the git commit so runs can be compared across commits.
+
+Usage:
+    python bench_latency.py --threads 1,2,4 --out bench.json
+    python bench_latency.py --checkpoint model_v2.pth --variants traced
+    python bench_latency.py --compare bench_before.json   # ratios against an earlier run
+    python bench_latency.py --attention   # fused vs basic-op attention: parity check + speedup
+"""
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from train import (
+    LayoutClassifier,
+    LayoutClassifierV2,
+    LayoutTransformer,
+    EnsembleModel,
+    INPUT_LENGTH,
+    VOCAB_SIZE,
+    TraceableMultiheadSelfAttention,
+    load_state_dict_file,
+    set_fused_attention,
+)
+from predict import detect_architecture, transformer_config
+
+ARCHITECTURES = ('v1', 'v2', 'transformer', 'ensemble')
+ATTENTION_ARCHITECTURES = ('transformer', 'ensemble')
+# (d_model, nhead) of the attention parity / speed check: the defaults, then narrower sweep sizes.
+ATTENTION_CONFIGS = ((128, 8), (128, 4), (64, 4), (32, 4))
+
+def build(arch, traceable, state=None, nhead=8):
+    """Eval-mode model of `arch`; traceable selects the basic-op attention export.py traces."""
+    if arch == 'ensemble':
+        model = EnsembleModel(traceable_transformer=traceable)
+    elif arch == 'transformer':
+        config = transformer_config(state, nhead) if state is not None else {}
+        model = LayoutTransformer(traceable=traceable, **config)
+    elif arch == 'v2':
+        model = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(state)) if state is not None else LayoutClassifierV2()
+    else:
+        model = LayoutClassifier()
+    if state is not None:
+        model.load_state_dict(state)
+    return model.eval()
+
+def max_abs_diff(a, b):
+    return (a - b).abs().max().item()
+
+def attention_parity(d_model, nhead, batch_size, seed=0):
+    """Largest output / relative gradient / logit differences between the fused and basic-op attention.
+
+    Outputs and input gradients of one attention module (train mode, dropout 0) with shared
+    weights, then LayoutTransformer logits (eval mode) after set_fused_attention.
+    """
+    torch.manual_seed(seed)
+    basic = TraceableMultiheadSelfAttention(d_model, nhead)
+    fused = TraceableMultiheadSelfAttention(d_model, nhead, fused=True)
+    fused.load_state_dict(basic.state_dict())
+    x = torch.randn(batch_size, INPUT_LENGTH, d_model)
+    x_basic, x_fused = x.clone().requires_grad_(), x.clone().requires_grad_()
+    out_basic, out_fused = basic(x_basic), fused(x_fused)
+    out_basic.square().sum().backward()
+    out_fused.square().sum().backward()
+    # Gradients scale with batch size and magnitude: compare relative to the largest entry.
+    pairs = [(x_basic.grad, x_fused.grad)] + [(p.grad, q.grad) for p, q in zip(basic.parameters(), fused.parameters())]
+    grads = [max_abs_diff(a, b) / max(a.abs().max().item(), 1e-12) for a, b in pairs]
+
+    model = LayoutTransformer(d_model=d_model, nhead=nhead, traceable=True).eval()
+    ids = torch.randint(0, VOCAB_SIZE, (batch_size, INPUT_LENGTH), dtype=torch.long)
+    with torch.inference_mode():
+        logits_basic = model(ids)
+        if set_fused_attention(model) != len(model.transformer.layers):
+            raise SystemExit("set_fused_attention did not switch every encoder layer")
+        logits_fused = model(ids)
+    return {
+        'output': max_abs_diff(out_basic, out_fused),
+        'grad_rel': max(grads),
+        'logits': max_abs_diff(logits_basic, logits_fused),
+    }
+
+def train_step_ms(model, batch_size, warmup, runs):
+    """Mean forward + backward ms of `model` (train mode) on a random batch."""
+    model.train()
+    ids = torch.randint(0, VOCAB_SIZE, (batch_size, INPUT_LENGTH), dtype=torch.long)
+    for i in range(warmup + runs):
+        if i == warmup:
+            start = time.perf_counter()
+        model.zero_grad(set_to_none=True)
+        model(ids).sum().backward()
+    return 1000 * (time.perf_counter() - start) / runs
+
+def bench_attention(args):
+    """--attention: parity and speed of fused vs basic-op attention for ATTENTION_CONFIGS.
+
+    Exits non-zero at the first configuration whose differences exceed --parity-tol,
+    before any timing.
+    """
+    rows = []
+    for d_model, nhead in ATTENTION_CONFIGS:
+        diffs = {}
+        for batch_size in (1, 64):
+            for key, value in attention_parity(d_model, nhead, batch_size).items():
+                diffs[key] = max(diffs.get(key, 0.0), value)
+        failed = {key: value for key, value in diffs.items() if not value <= args.parity_tol}
+        if failed:
+            raise SystemExit(f"Fused attention parity FAILED for d_model {d_model} nhead {nhead}: "
+                             + ", ".join(f"{key} {value:.1e}" for key, value in failed.items())
+                             + f" > tol {args.parity_tol}")
+        row = {'d_model': d_model, 'nhead': nhead, 'parity': diffs}
+        basic = LayoutTransformer(d_model=d_model, nhead=nhead, traceable=True).eval()
+        fused = copy.deepcopy(basic)
+        set_fused_attention(fused)
+        for name, model in (('basic', basic), ('fused', fused)):
+            times = latency_ms(model.eval(), args.warmup, args.runs)
+            row[f'{name}_p50_ms'] = float(np.percentile(times, 50))
+            row[f'{name}_samples_per_sec'] = throughput(model, max(args.batch_sizes), 2, args.min_seconds)
+            row[f'{name}_train_step_ms'] = train_step_ms(model, 512, 2, 10)
+        rows.append(row)
+        print(f"  d_model {d_model:3d} nhead {nhead}: parity OK, max diff "
+              f"out {diffs['output']:.1e} grad (rel) {diffs['grad_rel']:.1e} logits {diffs['logits']:.1e} | fused speedup: "
+              f"batch-1 p50 {row['basic_p50_ms'] / row['fused_p50_ms']:.2f}x, "
+              f"bs{max(args.batch_sizes)} {row['fused_samples_per_sec'] / row['basic_samples_per_sec']:.2f}x, "
+              f"train step (bs512) {row['basic_train_step_ms'] / row['fused_train_step_ms']:.2f}x")
+    return rows
+
+def variant_model(model, variant):
+    if variant == 'traced':
+        example = torch.randint(0, VOCAB_SIZE, (1, INPUT_LENGTH), dtype=torch.long)
+        with torch.inference_mode(), warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)  # jit deprecation notices; CoreML export still traces
+            return torch.jit.freeze(torch.jit.trace(model, example))
+    return model
+
+def git_commit():
+    """(commit hash, working tree dirty) of the repository, or (None, None) outside git."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo, text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def pin_threads(threads, cores):
+    """Use `threads` torch threads, pinned to the first `threads` of `cores` where supported."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores[:threads])
+    torch.set_num_threads(threads)
+
+def latency_ms(model, warmup, runs):
+    """Per-call batch-1 latencies in ms."""
+    x = torch.randint(0, VOCAB_SIZE, (1, INPUT_LENGTH), dtype=torch.long)
+    times = np.empty(runs)
+    with torch.inference_mode():
+        for _ in range(warmup):
+            model(x)
+        for i in range(runs):
+            start = time.perf_counter()
+            model(x)
+            times[i] = time.perf_counter() - start
+    return 1000 * times
+
+def throughput(model, batch_size, warmup, min_seconds):
+    """Samples/s at `batch_size`, timed over at least min_seconds."""
+    x = torch.randint(0, VOCAB_SIZE, (batch_size, INPUT_LENGTH), dtype=torch.long)
+    with torch.inference_mode():
+        for _ in range(warmup):
+            model(x)
+        calls, start = 0, time.perf_counter()
+        while calls < 3 or time.perf_counter() - start < min_seconds:
+            model(x)
+            calls += 1
+    return calls * batch_size / (time.perf_counter() - start)
+
+def bench(name, arch, model, variant, threads, args):
+    row = {'model': name, 'arch': arch, 'variant': variant, 'threads': threads,
+           'params': sum(p.numel() for p in model.parameters())}
+    runnable = variant_model(model, variant)
+    times = latency_ms(runnable, args.warmup, args.runs)
+    row.update({
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'mean_ms': float(times.mean()),
+    })
+    row['samples_per_sec'] = {
+        str(bs): throughput(runnable, bs, max(1, args.warmup // 10), args.min_seconds) for bs in args.batch_sizes
+    }
+    return row
+
+def row_key(row):
+    return (row['model'], row['variant'], row['threads'])
+
+def print_rows(rows, baseline=None):
+    base = {row_key(r): r for r in (baseline or [])}
+    for row in rows:
+        line = (f"  {row['model']:14s} {row['variant']:7s} {row['threads']:2d}t  "
+                f"p50 {row['p50_ms']:7.3f}  p95 {row['p95_ms']:7.3f}  p99 {row['p99_ms']:7.3f} ms  "
+                + "  ".join(f"bs{bs} {sps:9,.0f}/s" for bs, sps in row['samples_per_sec'].items()))
+        old = base.get(row_key(row))
+        if old is not None:
+            line += f"  | p50 {old['p50_ms'] / row['p50_ms']:.2f}x vs baseline"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU latency/throughput benchmark of the layout classifiers")
+    parser.add_argument('--models', default=','.join(ARCHITECTURES), help="Random-weight architectures to run (comma list, '' for none)")
+    parser.add_argument('--checkpoint', action='append', default=[], help="Trained .pth to include (architecture read from its keys); repeatable")
+    parser.add_argument('--nhead', type=int, default=8, help="Attention heads of transformer checkpoints")
+    parser.add_argument('--variants', default='eager,traced', help="eager, traced (torch.jit.trace + freeze of the traceable graph) and/or fused (traceable graph, SDPA attention)")
+    parser.add_argument('--threads', default='1,2,4', help="torch thread counts (comma list); each run is pinned to that many cores")
+    parser.add_argument('--batch-sizes', default='64,512,4096', help="Batch sizes for the throughput measurement")
+    parser.add_argument('--warmup', type=int, default=50, help="Untimed batch-1 calls before measuring")
+    parser.add_argument('--runs', type=int, default=1000, help="Timed batch-1 calls")
+    parser.add_argument('--min-seconds', type=float, default=1.0, help="Minimum timing window per throughput batch size")
+    parser.add_argument('--out', default='bench_latency.json')
+    parser.add_argument('--compare', default=None, help="Earlier --out JSON to print p50 ratios against")
+    parser.add_argument('--attention', action='store_true', help="Only check fused vs basic-op attention: parity (exits non-zero on failure) and speedup")
+    parser.add_argument('--parity-tol', type=float, default=1e-4, help="Max abs difference allowed by --attention")
+    args = parser.parse_args()
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',') if b]
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    thread_counts = sorted({int(t) for t in args.threads.split(',')})
+    if max(thread_counts) > len(cores):
+        print(f"Only {len(cores)} cores available: dropping thread counts above that")
+        thread_counts = [t for t in thread_counts if t <= len(cores)] or [len(cores)]
+
+    # (name, arch, state_dict or None)
+    models = [(arch, arch, None) for arch in args.models.split(',') if arch]
+    for path in args.checkpoint:
+        state = load_state_dict_file(path)
+        models.append((os.path.basename(path), detect_architecture(state), state))
+
+    commit, dirty = git_commit()
+    print(f"Benchmark @ {commit[:10] if commit else 'unknown commit'}{' (dirty)' if dirty else ''}, "
+          f"torch {torch.__version__}, {len(cores)} cores, threads {thread_counts}")
+    if args.attention:
+        pin_threads(thread_counts[0], cores)
+        print(f"Fused (scaled_dot_product_attention) vs basic-op attention, {thread_counts[0]} threads, tol {args.parity_tol}")
+        attention_rows = bench_attention(args)
+    rows = []
+    for name, arch, state in ([] if args.attention else models):
+        for variant in args.variants.split(','):
+            if variant == 'fused' and arch not in ATTENTION_ARCHITECTURES:
+                continue
+            # Tracing needs the basic-op attention; eager runs what training uses.
+            model = build(arch, traceable=variant != 'eager', state=state, nhead=args.nhead)
+            if variant == 'fused':
+                set_fused_attention(model)
+            for threads in thread_counts:
+                pin_threads(threads, cores)
+                rows.append(bench(name, arch, model, variant, threads, args))
+                print_rows(rows[-1:])
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    result = {
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cores': len(cores),
+        'input_length': INPUT_LENGTH,
+        'warmup': args.warmup,
+        'runs': args.runs,
+        'results': rows,
+    }
+    if args.attention:
+        result['attention'] = attention_rows
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nAgainst {args.compare} ({(baseline.get('git_commit') or 'unknown')[:10]}; >1x = faster now):")
+        print_rows(rows, baseline['results'])
+
+if __name__ == "__main__":
+    main()
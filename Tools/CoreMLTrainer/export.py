@@ -5,6 +5,7 @@ import argparse
 
 def export(args):
     # Load PyTorch model
+    state_dict = torch.load(args.model_in, map_location='cpu', weights_only=True)
     if args.ensemble:
         model = EnsembleModel(traceable_transformer=True)
         print("Loading EnsembleModel (CNN + Transformer)")
@@ -12,13 +13,14 @@ def export(args):
         model = LayoutTransformer(traceable=True)
         print("Loading LayoutTransformer")
     elif args.model_v2:
-        model = LayoutClassifierV2()
+        # Widths come from the checkpoint, so prune.py outputs export like full-size ones.
+        model = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(state_dict))
         print("Loading LayoutClassifierV2 (enhanced CNN)")
     else:
         model = LayoutClassifier()
         print("Loading LayoutClassifier (basic)")
     
-    model.load_state_dict(torch.load(args.model_in, map_location='cpu', weights_only=True))
+    model.load_state_dict(state_dict)
     model.eval()
     
     # Count parameters
@@ -37,6 +39,11 @@ def export(args):
         convert_to="neuralnetwork"
     )
     
+    # int8 weights, per-channel symmetric: the scheme train.py --qat simulates.
+    if args.quantize == "int8":
+        from coremltools.models.neural_network import quantization_utils
+        mlmodel = quantization_utils.quantize_weights(mlmodel, nbits=8, quantization_mode="linear_symmetric")
+    
     # Add metadata
     model_type = "ensemble" if args.ensemble else ("transformer" if args.transformer else ("v2" if args.model_v2 else "v1"))
     mlmodel.author = "OMFK Agent"
@@ -45,6 +52,7 @@ def export(args):
     mlmodel.user_defined_metadata["input_length"] = str(INPUT_LENGTH)
     mlmodel.user_defined_metadata["model_version"] = model_type
     mlmodel.user_defined_metadata["parameters"] = str(total_params)
+    mlmodel.user_defined_metadata["quantization"] = args.quantize
     
     # Save
     mlmodel.save(args.output)
@@ -52,6 +60,7 @@ def export(args):
     print(f"  Input length: {INPUT_LENGTH}")
     print(f"  Classes: {len(CLASSES)}")
     print(f"  Model type: {model_type}")
+    print(f"  Weights: {args.quantize}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -60,5 +69,6 @@ if __name__ == "__main__":
     parser.add_argument('--model_v2', action='store_true', help="Export V2 CNN architecture")
     parser.add_argument('--transformer', action='store_true', help="Export Transformer architecture")
     parser.add_argument('--ensemble', action='store_true', help="Export Ensemble (CNN+Transformer)")
+    parser.add_argument('--quantize', choices=['none', 'int8'], default='none', help="Quantize weights (use a train.py --qat checkpoint for int8)")
     args = parser.parse_args()
     export(args)
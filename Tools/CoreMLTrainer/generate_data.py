@@ -2,6 +2,15 @@ import json
 import random
 import os
 import argparse
+import hashlib
+import math
+import time
+from collections import Counter
+
+import numpy as np
+
+from vocab import CLASSES, CLASS_TO_IDX, encode_texts
+from tokenized import TokenizedWriter
 
 # Seed lexicons for MVP (Top ~50 words per language to capture reasonable N-grams)
 # In a real production run, download_corpus.py would populate these.
@@ -18,119 +27,236 @@ SEEDS = {
     "he": "את ב של לא ה ל זה כי גם היה עם על אני מה כן אם הוא כל אבל יש לא רק או מי זה אתה איך מתי איפה שם כאן למה מי היה כדי פעם תמיד טוב יום בית איש דבר עולם חיים משפחה אהבה זמן עכשיו יותר מאוד רוצה צריך יכול עושה רואה יודע חושב אומר בא דרך מים לחם שמש ירח ארץ עיר ספר ילד".split() + COMMON_SEEDS["he"]
 }
 
-CLASSES = [
-    'ru', 'en', 'he',
-    'ru_from_en', 'he_from_en',
-    'en_from_ru', 'en_from_he',
-    'he_from_ru', 'ru_from_he'
-]
+# Optional per-language AliasTable aligned with SEEDS[lang] (see --word-source unigrams).
+WORD_WEIGHTS = {}
+
+
+# Primary layouts to use (Lists to support multiple variants)
+DEFAULT_LAYOUTS = {
+    'en': ['en_us'],
+    'ru': ['ru_pc', 'ru_phonetic_yasherty'],
+    'he': ['he_standard', 'he_qwerty', 'he_pc'] # Support ALL common Hebrew layouts
+}
+
+def build_pair_mapping(key_map, s_layout, t_layout):
+    """Char map for a user who intends to type on s_layout but is actually on t_layout.
+
+    layouts.json is Key -> Layout -> Char, so for each physical key the char it
+    produces on s_layout maps to the char the same key produces on t_layout
+    (e.g. ru_pc 'п' -> en_us 'g' for KeyG). Normal and Shift levels are both used.
+    """
+    mapping = {}
+    for per_layout in key_map.values():
+        s_val = per_layout.get(s_layout)
+        t_val = per_layout.get(t_layout)
+        if not s_val or not t_val:
+            continue
+        for mod in ('n', 's'):
+            s_char = s_val.get(mod)
+            t_char = t_val.get(mod)
+            if s_char and t_char:
+                mapping[s_char] = t_char
+    return mapping
+
+class LayoutPairList:
+    """Lazy sequence of char maps, one per (intended layout, typed layout) pair.
+
+    Maps are built on first access and cached, so supporting many layouts costs
+    nothing until a pair is actually sampled. Index order matches the old eager
+    list: intended layout major, typed layout minor.
+    """
+
+    def __init__(self, key_map, src_layouts, tgt_layouts):
+        self.key_map = key_map
+        self.src_layouts = list(src_layouts)
+        self.tgt_layouts = list(tgt_layouts)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.src_layouts) * len(self.tgt_layouts)
+
+    def layout_pair(self, i):
+        return self.src_layouts[i // len(self.tgt_layouts)], self.tgt_layouts[i % len(self.tgt_layouts)]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        mapping = self._cache.get(i)
+        if mapping is None:
+            mapping = build_pair_mapping(self.key_map, *self.layout_pair(i))
+            if not mapping:
+                # An empty map would emit the intended text unchanged under a *_from_* label.
+                raise ValueError(f"Layouts {' and '.join(self.layout_pair(i))} share no keys in the layout map")
+            self._cache[i] = mapping
+        return mapping
+
+def layout_languages(data):
+    """{layout id: language} for every layout that has keys in data['map'].
+
+    The language comes from the metadata list, falling back to the id prefix (en_us -> en).
+    Ids without map entries are left out: their pair maps would be empty.
+    """
+    meta = {entry['id']: entry.get('language') for entry in data.get('layouts', [])}
+    known = {}
+    for per_layout in data['map'].values():
+        for layout_id in per_layout:
+            if layout_id not in known:
+                known[layout_id] = meta.get(layout_id) or layout_id.split('_', 1)[0]
+    return known
+
+def select_layouts(data, layouts_set='default'):
+    """Return {lang: [layout ids]} for --layouts-set default|all|<comma-separated ids>.
+
+    Only layouts present in data['map'] are used. A language with none selected in a
+    list falls back to every layout of that language in the file.
+    """
+    known = layout_languages(data)
+    layouts = {'en': [], 'ru': [], 'he': []}
+    if layouts_set in (None, '', 'default'):
+        for lang, ids in DEFAULT_LAYOUTS.items():
+            missing = [l for l in ids if l not in known]
+            if missing:
+                print(f"Warning: default {lang} layouts not in the layout map, skipped: {', '.join(missing)}")
+            layouts[lang] = [l for l in ids if l in known]
+            if not layouts[lang]:
+                raise ValueError(f"None of the default {lang} layouts ({', '.join(ids)}) are in the layout map; "
+                                 "use --layouts-set all or a list of its layout ids")
+        return layouts
+
+    if layouts_set == 'all':
+        wanted = list(known)
+    else:
+        wanted = [l.strip() for l in layouts_set.split(',') if l.strip()]
+        missing = [l for l in wanted if l not in known]
+        if missing:
+            raise ValueError(f"Unknown layouts in --layouts-set: {', '.join(missing)}")
 
-def load_layout_map(json_path, focus_layout=None):
+    for layout_id in wanted:
+        lang = known[layout_id]
+        if lang in layouts:
+            layouts[lang].append(layout_id)
+    for lang, ids in layouts.items():
+        if not ids:
+            ids[:] = [l for l, l_lang in known.items() if l_lang == lang]
+            if not ids:
+                raise ValueError(f"The layout map has no {lang} layouts")
+            print(f"Warning: no {lang} layouts selected, {lang} classes will use all {len(ids)} in the layout map")
+    return layouts
+
+def load_layout_map(json_path, focus_layout=None, layouts_set='default'):
+    """Return (maps, {layout id: language}, focus language or None).
+
+    --focus-layout narrows its language's pair maps to that one layout; select_classes
+    must be given the same id -> language mapping so the classes follow.
+    """
     with open(json_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
-    
-    # We need to build char->char maps for layout conversion.
-    # Map key: (source_layout, target_layout) -> {source_char: target_char}
-    
-    # Primary layouts to use
-    # Primary layouts to use (Lists to support multiple variants)
-    layouts = {
-        'en': ['en_us'],
-        'ru': ['ru_pc', 'ru_phonetic_yasherty'],
-        'he': ['he_standard', 'he_qwerty', 'he_pc'] # Support ALL common Hebrew layouts
-    }
 
+    layouts = select_layouts(data, layouts_set)
+    languages = layout_languages(data)
+
+    focus_lang = None
     if focus_layout:
-        focus_lang = focus_layout.split('_', 1)[0] if '_' in focus_layout else focus_layout
-        if focus_lang in layouts and focus_layout in layouts[focus_lang]:
+        focus_lang = languages.get(focus_layout)
+        if focus_lang in layouts:
             layouts[focus_lang] = [focus_layout]
         else:
-            print(f"Warning: focus layout '{focus_layout}' not found in presets, ignoring")
-    
-    maps = {}
-    
+            focus_lang = None
+            print(f"Warning: focus layout '{focus_layout}' not found in {json_path}, ignoring")
+
+    # Class naming is "tgt_from_src" as seen by the model (e.g. "ru_from_en": RU intended,
+    # typed on an EN layout); maps are keyed the other way round: "en_from_ru" turns
+    # RU text into what the EN layout produces for the same keys.
     key_map = data['map']
-    
-    def get_char(k, l_id, mod='n'):
-        val = key_map.get(k, {}).get(l_id, {})
-        if val:
-            return val.get(mod)
-        return None
-
-    # Build maps between all pairs
-    # Since we have lists of layouts, we generate a map for each specific layout pair
-    # and store them in a list under the language pair key.
-    
+    maps = {}
     for src_lang, src_layout_list in layouts.items():
         for tgt_lang, tgt_layout_list in layouts.items():
             if src_lang == tgt_lang: continue
-            
-            # We want to support: User intends src_lang, but is typing on tgt_layout.
-            # Wait, the class naming is "tgt_from_src" (e.g., "ru_from_en").
-            # This means: "Detected as RU, but coming from EN layout input".
-            # My logic in generate_sample:
-            # intended_lang = ru
-            # typed_layout_lang = en
-            # We need map: RU -> EN.
-            # i.e., what keys does user press to type RU word?
-            # And what characters do those keys produce on EN layout?
-            
-            # The user presses a physical key.
-            # If user intends RU (e.g. "привет"), they press keys G, H, ...
-            # Wait. "привет" is typed on `ru_pc`.
-            # Keys: G (п), H (р), B (и), ...
-            # Make sure we use the CORRECT RU layout they utilize.
-            # If they use `ru_pc`, they press `KeyG`.
-            # If they are on `en_us` layout, `KeyG` produces `g`.
-            
-            # So, for each possible intended layout (e.g. `ru_pc`):
-            # And each possible actual layout (e.g. `en_us`):
-            # We create a map.
-            
-            pair_key = f"{tgt_lang}_from_{src_lang}" # e.g. en_from_ru (EN chars from RU intention)
-            
-            if pair_key not in maps:
-                maps[pair_key] = []
-            
-            for s_layout in src_layout_list:
-                for t_layout in tgt_layout_list:
-                    
-                    mapping = {}
-                    for key_code in key_map:
-                        # Character produced by key in INTENDED layout (s_layout)
-                        # This works backwards:
-                        # We have intended char (e.g. 'п').
-                        # We find key code that produces it in s_layout (KeyG).
-                        # We find char produced by that key code in t_layout ('g').
-                        
-                        # Optimization: Layouts.json map is Key -> Layout -> Char.
-                        # So for each KEY, we map s_char -> t_char
-                        
-                        # Normal
-                        s_char = get_char(key_code, s_layout, 'n')
-                        t_char = get_char(key_code, t_layout, 'n')
-                        if s_char and t_char:
-                            mapping[s_char] = t_char
-                        
-                        # Shift
-                        s_char_s = get_char(key_code, s_layout, 's')
-                        t_char_s = get_char(key_code, t_layout, 's')
-                        if s_char_s and t_char_s:
-                            mapping[s_char_s] = t_char_s
-                    
-                    maps[pair_key].append(mapping)
-            
-    return maps
+            maps[f"{tgt_lang}_from_{src_lang}"] = LayoutPairList(key_map, src_layout_list, tgt_layout_list)
+
+    return maps, languages, focus_lang
 
 def convert_text(text, mapping):
     return "".join(mapping.get(c, c) for c in text)
 
+class AliasTable:
+    """Walker alias table (Vose's construction) for O(1) weighted index draws."""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = weights * (n / weights.sum())
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+
+        small = np.flatnonzero(scaled < 1.0).tolist()
+        large = np.flatnonzero(scaled >= 1.0).tolist()
+        scaled = scaled.tolist()
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(large.pop())
+        # Leftovers are 1.0 up to rounding error; keep prob=1 for them.
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, rng, size):
+        """Draw `size` indices with a NumPy Generator."""
+        idx = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[idx], idx, self.alias[idx])
+
+    def draw_one(self):
+        """Draw a single index with the `random` module (scalar sampler)."""
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else int(self.alias[i])
+
+def load_unigram_words(path, temperature=1.0):
+    """Read a `word<TAB>count` TSV into (words, AliasTable).
+
+    Counts are raised to 1/temperature, so temperature > 1 flattens the Zipf
+    distribution towards uniform and temperature < 1 sharpens it.
+    """
+    words = []
+    counts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 2:
+                continue
+            word, count = parts[0], parts[1]
+            # Same filter as corpus words.
+            if 2 <= len(word) < 20 and ' ' not in word:
+                try:
+                    c = float(count)
+                except ValueError:
+                    continue
+                if c > 0:
+                    words.append(word)
+                    counts.append(c)
+    if not words:
+        return [], None
+    weights = np.asarray(counts, dtype=np.float64) ** (1.0 / temperature)
+    return words, AliasTable(weights)
+
+def pick_word(lang):
+    table = WORD_WEIGHTS.get(lang)
+    if table is not None:
+        return SEEDS[lang][table.draw_one()]
+    return random.choice(SEEDS[lang])
+
 def generate_sample(class_name, maps, max_phrase_len=3):
     # Determine source language and transformation
     if class_name in ['ru', 'en', 'he']:
         src_lang = class_name
         num_words = random.randint(1, max_phrase_len)
-        words = [random.choice(SEEDS[src_lang]) for _ in range(num_words)]
+        words = [pick_word(src_lang) for _ in range(num_words)]
         return " ".join(words), class_name
     
     parts = class_name.split('_from_')
@@ -143,16 +269,349 @@ def generate_sample(class_name, maps, max_phrase_len=3):
         
     mapping = random.choice(available_maps)
     num_words = random.randint(1, max_phrase_len)
-    words = [random.choice(SEEDS[intended_lang]) for _ in range(num_words)]
+    words = [pick_word(intended_lang) for _ in range(num_words)]
     text = " ".join(words)
     converted = convert_text(text, mapping)
     return converted, class_name
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--output', default='training_data.csv')
-    parser.add_argument('--count', type=int, default=1000000)
+class BatchSampler:
+    """Vectorized counterpart of generate_sample.
+
+    Draws class ids, phrase lengths and word indices for a whole batch with one
+    NumPy Generator call each, then assembles and converts the phrases of each
+    class in one pass over a joined string.
+    """
+
+    # Terminates each phrase in joined batch strings; never produced by layouts.json maps.
+    SEPARATOR = "\x1f"
+    # Code points covered by the conversion lookup tables (Latin, Cyrillic, Hebrew, punctuation).
+    LUT_SIZE = 0x3000
+
+    def __init__(self, maps, words, pure_classes, from_classes, balance=0.5, max_phrase_len=3, seed=None, word_weights=None):
+        self.maps = maps
+        self.words = {lang: np.asarray(w, dtype=object) for lang, w in words.items()}
+        self.word_weights = dict(word_weights or {})
+        self.classes = list(pure_classes) + list(from_classes)
+        self.class_names = np.asarray(self.classes, dtype=object)
+        self.num_pure = len(pure_classes)
+        self.num_from = len(from_classes)
+        self.balance = balance
+        self.max_phrase_len = max_phrase_len
+        self.rng = np.random.default_rng(seed)
+        self._conversions = {}
+
+    def _conversion_state(self, map_key, map_ids):
+        """Stacked lookup tables for map_key, with every map in map_ids built.
+
+        Maps are materialized lazily (only once a layout pair is sampled). 1:1 maps
+        become one row of a [n_maps, LUT_SIZE] code point table, so a whole class
+        converts in one indexing op however many layout pairs it spans. Maps with
+        multi-char outputs keep an identity row and a str.translate table instead.
+        """
+        available_maps = self.maps[map_key]
+        state = self._conversions.get(map_key)
+        if state is None:
+            state = self._conversions[map_key] = {
+                'lut': np.tile(np.arange(self.LUT_SIZE, dtype=np.uint32), (len(available_maps), 1)),
+                'built': np.zeros(len(available_maps), dtype=bool),
+                'tables': {},
+            }
+
+        for map_idx in np.unique(map_ids[~state['built'][map_ids]]).tolist():
+            mapping = {
+                s: t for s, t in available_maps[map_idx].items()
+                if len(s) == 1 and s != self.SEPARATOR
+            }
+            if all(len(t) == 1 and ord(s) < self.LUT_SIZE for s, t in mapping.items()):
+                for s, t in mapping.items():
+                    state['lut'][map_idx, ord(s)] = ord(t)
+            else:
+                state['tables'][map_idx] = str.maketrans(mapping)
+            state['built'][map_idx] = True
+        return state
+
+    def _convert(self, map_key, joined, map_ids):
+        """Convert SEPARATOR-terminated phrases, phrase i with map map_ids[i]."""
+        state = self._conversion_state(map_key, map_ids)
+        cps = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+        ends = np.flatnonzero(cps == ord(self.SEPARATOR))
+        char_maps = np.repeat(map_ids, np.diff(ends, prepend=-1))
+        inside = cps < self.LUT_SIZE
+        converted = np.where(inside, state['lut'][char_maps, np.where(inside, cps, 0)], cps)
+        phrases = converted.tobytes().decode('utf-32-le').split(self.SEPARATOR)[:-1]
+
+        for map_idx, table in state['tables'].items():
+            sel = np.flatnonzero(map_ids == map_idx).tolist()
+            if sel:
+                group = self.SEPARATOR.join([phrases[i] for i in sel]).translate(table)
+                for i, text in zip(sel, group.split(self.SEPARATOR)):
+                    phrases[i] = text
+        return phrases
+
+    def _draw_classes(self, n):
+        # Same semantics as the scalar loop: `balance` chance of a pure class,
+        # otherwise a uniformly chosen _from_ class.
+        rng = self.rng
+        if self.num_from == 0:
+            return rng.integers(self.num_pure, size=n)
+        if self.num_pure == 0:
+            return rng.integers(self.num_from, size=n)
+        pure = rng.random(n) < self.balance
+        pure_ids = rng.integers(self.num_pure, size=n)
+        from_ids = self.num_pure + rng.integers(self.num_from, size=n)
+        return np.where(pure, pure_ids, from_ids)
+
+    def _joined_phrases(self, lang, lengths):
+        """Build len(lengths) phrases as one string, each terminated by SEPARATOR.
+
+        Words are drawn into a padded [n, max_phrase_len] matrix and interleaved
+        with separators, so the whole group is assembled by a single str.join.
+        """
+        n = len(lengths)
+        width = self.max_phrase_len
+        words = self.words[lang]
+
+        table = self.word_weights.get(lang)
+        if table is not None:
+            word_ids = table.draw(self.rng, (n, width))
+        else:
+            word_ids = self.rng.integers(len(words), size=(n, width))
+
+        tokens = np.empty((n, 2 * width), dtype=object)
+        tokens[:, 0::2] = words[word_ids]
+        pos = np.arange(width)
+        tokens[:, 1::2] = np.where(pos < lengths[:, None] - 1, " ", "")
+        tokens[:, 0::2][pos >= lengths[:, None]] = ""
+        tokens[np.arange(n), 2 * lengths - 1] = self.SEPARATOR
+        return "".join(tokens.ravel().tolist())
+
+    def sample(self, n):
+        """Return (texts, labels) lists for n freshly drawn samples."""
+        class_ids = self._draw_classes(n)
+        lengths = self.rng.integers(1, self.max_phrase_len + 1, size=n)
+
+        texts = np.empty(n, dtype=object)
+        for class_id in np.unique(class_ids).tolist():
+            rows = np.flatnonzero(class_ids == class_id)
+            class_name = self.classes[class_id]
+            if '_from_' not in class_name:
+                joined = self._joined_phrases(class_name, lengths[rows])
+                texts[rows] = joined.split(self.SEPARATOR)[:-1]
+                continue
+
+            intended_lang, typed_layout_lang = class_name.split('_from_')
+            map_key = f"{typed_layout_lang}_from_{intended_lang}"
+            available_maps = self.maps.get(map_key, [])
+            if not available_maps:
+                texts[rows] = "x"
+                continue
+
+            map_ids = self.rng.integers(len(available_maps), size=len(rows))
+            joined = self._joined_phrases(intended_lang, lengths[rows])
+            texts[rows] = self._convert(map_key, joined, map_ids)
+
+        return texts.tolist(), self.class_names[class_ids].tolist()
+
+def iter_corpus_words(f):
+    for line in f:
+        for p in line.strip().split():
+            # Include 2-letter words; they're important for HE (e.g. מה, לא) and short EN/RU tokens.
+            if 2 <= len(p) < 20:
+                yield p
+
+def _open_unit(rng):
+    # Uniform in (0, 1): Algorithm L takes logs of these draws.
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+def reservoir_sample(items, k, rng=random):
+    """Uniform sample of k items in one pass (Li's Algorithm L).
+
+    Instead of drawing a random index for every item, jump straight to the next
+    item that enters the reservoir, so the RNG is used O(k log(n/k)) times.
+    """
+    it = iter(items)
+    reservoir = []
+    for item in it:
+        reservoir.append(item)
+        if len(reservoir) >= k:
+            break
+    if len(reservoir) < k:
+        return reservoir
+
+    w = math.exp(math.log(_open_unit(rng)) / k)
+    next_pick = k + math.floor(math.log(_open_unit(rng)) / math.log(1.0 - w))
+    for i, item in enumerate(it, start=k):
+        if i == next_pick:
+            reservoir[rng.randrange(k)] = item
+            w *= math.exp(math.log(_open_unit(rng)) / k)
+            next_pick += math.floor(math.log(_open_unit(rng)) / math.log(1.0 - w)) + 1
+    return reservoir
+
+def file_digest(path, chunk_size=16 * 1024 * 1024):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_corpus_words(path, max_words, sample_mode, cache_dir=None, seed=None):
+    """Load acceptable words from a corpus file, sampled or capped to max_words.
+
+    Reservoir samples are cached in cache_dir, keyed by the corpus content hash,
+    max_words and seed, so repeated runs over the same corpus skip the scan.
+    """
+    reservoir = bool(max_words) and sample_mode == 'reservoir'
+    cache_path = None
+    if reservoir and cache_dir:
+        key = f"{file_digest(path)}-{max_words}" + (f"-s{seed}" if seed is not None else "")
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(path)}.{key}.words")
+        if os.path.exists(cache_path):
+            print(" [cached sample]", end='', flush=True)
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return f.read().split('\n') if os.path.getsize(cache_path) else []
+
+    with open(path, 'r', encoding='utf-8') as f:
+        if reservoir:
+            # Own RNG, so a warm cache (which skips these draws) leaves the generation RNG untouched.
+            rng = random.Random(f"{seed}:{os.path.basename(path)}") if seed is not None else random.Random()
+            words = reservoir_sample(iter_corpus_words(f), max_words, rng)
+        else:
+            # Fast path: take the first N acceptable words.
+            words = []
+            for p in iter_corpus_words(f):
+                words.append(p)
+                if max_words and len(words) >= max_words:
+                    break
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(words))
+        os.replace(tmp_path, cache_path)
+    return words
+
+class DedupIndex:
+    """Compact text -> label-set index for duplicate and cross-class collision checks.
+
+    Stores only a 64-bit hash of every emitted text with a bitmask of the labels it
+    was emitted under, and stops growing once the memory budget is reached (rows
+    with unseen texts then pass unchecked).
+    """
+
+    # Approximate CPython cost of one int -> int dict item (slot + key/value objects).
+    BYTES_PER_ENTRY = 104
+
+    def __init__(self, classes, memory_mb=256, drop_duplicates=True, collisions='drop'):
+        self.classes = list(classes)
+        self.class_bit = {c: 1 << i for i, c in enumerate(self.classes)}
+        self.capacity = int(memory_mb * 1024 * 1024) // self.BYTES_PER_ENTRY
+        self.drop_duplicates = drop_duplicates
+        self.collisions = collisions
+        self.masks = {}
+        self.full = False
+        self.duplicates = 0
+        self.class_counts = Counter()
+        self.pair_counts = Counter()
+
+    def _first_label(self, mask):
+        return self.classes[(mask & -mask).bit_length() - 1]
+
+    def filter(self, texts, labels):
+        """Return (texts, labels) with duplicates/collisions handled per policy."""
+        out_texts, out_labels = [], []
+        masks = self.masks
+        for text, label in zip(texts, labels):
+            self.class_counts[label] += 1
+            key = hash(text)
+            bit = self.class_bit[label]
+            mask = masks.get(key)
+            if mask is None:
+                if len(masks) < self.capacity:
+                    masks[key] = bit
+                else:
+                    self.full = True
+            elif mask & bit:
+                if self.drop_duplicates:
+                    self.duplicates += 1
+                    continue
+            else:
+                # Same text already emitted under another label.
+                first = self._first_label(mask)
+                self.pair_counts[(first, label)] += 1
+                if self.collisions == 'drop':
+                    continue
+                if self.collisions == 'relabel':
+                    # Keep one label per text: the first one it was emitted with.
+                    if self.drop_duplicates:
+                        self.duplicates += 1
+                        continue
+                    label = first
+                else:
+                    masks[key] = mask | bit
+            out_texts.append(text)
+            out_labels.append(label)
+        return out_texts, out_labels
+
+    def report(self):
+        total = sum(self.class_counts.values())
+        print(f"Dedup: {len(self.masks)} distinct texts indexed, {self.duplicates} duplicate rows dropped "
+              f"({100 * self.duplicates / max(total, 1):.2f}% of {total} drawn)")
+        if self.full:
+            print(f"  Warning: index reached its memory budget ({self.capacity} entries); later texts were not checked.")
+        if not self.pair_counts:
+            print("  No cross-class collisions.")
+            return
+        print(f"  Cross-class collisions (policy: {self.collisions}), as % of the second class's rows:")
+        for (first, second), n in self.pair_counts.most_common():
+            print(f"    {first:>11} vs {second:<11} {n:>9}  ({100 * n / self.class_counts[second]:.2f}%)")
+
+def csv_field(text):
+    if ',' in text or '"' in text:
+        return f'"{text.replace(chr(34), chr(34)+chr(34))}"'
+    return text
+
+class CsvWriter:
+    """Batched CSV output: each batch becomes one joined buffer and one write() call."""
+
+    BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'w', encoding='utf-8', buffering=self.BUFFER_SIZE)
+        self._f.write("text,label\n")
+
+    def write(self, texts, labels):
+        if texts:
+            self._f.write("\n".join(map(",".join, zip(map(csv_field, texts), labels))) + "\n")
+
+    def close(self):
+        self._f.close()
+        return os.path.getsize(self.path)
+
+class TokensWriter:
+    """Writes texts pre-tokenized with train.py's ALPHABET (see tokenized.py)."""
+    def __init__(self, path):
+        self._writer = TokenizedWriter(path)
+
+    def write(self, texts, labels):
+        self._writer.write(encode_texts(texts), [CLASS_TO_IDX[label] for label in labels])
+
+    def close(self):
+        return self._writer.close()
+
+def add_source_args(parser):
+    """Register layout, word-source and class-mix flags (shared with train.py --stream)."""
     parser.add_argument('--layouts', default='../../.sdd/layouts.json')
+    parser.add_argument(
+        '--layouts-set',
+        default='default',
+        help="Layouts to generate from: 'default' (en_us, ru_pc, ru_phonetic_yasherty, Hebrew presets), "
+             "'all' (every layout in --layouts), or a comma-separated list of layout ids. Pair maps are built lazily.",
+    )
     parser.add_argument('--corpus_dir', default=None, help="Directory with {lang}.txt corpus files")
     parser.add_argument(
         '--max-corpus-words',
@@ -168,6 +627,25 @@ def main():
              "'head' reads the first N words (fast, biased). "
              "'reservoir' does one pass and keeps a uniform random sample (slower, higher quality).",
     )
+    parser.add_argument(
+        '--corpus-cache-dir',
+        default='.corpus_cache',
+        help="Where reservoir samples are cached per corpus content hash and --max-corpus-words. Empty string disables the cache.",
+    )
+    parser.add_argument(
+        '--word-source',
+        choices=['corpus', 'unigrams'],
+        default='corpus',
+        help="'corpus' samples words uniformly from --corpus_dir (or the built-in seeds). "
+             "'unigrams' draws words by frequency from {lang}_unigrams.tsv and skips the corpus scan for those languages.",
+    )
+    parser.add_argument('--unigrams-dir', default='../../OMFK/Sources/Resources/LanguageModels')
+    parser.add_argument(
+        '--unigram-temperature',
+        type=float,
+        default=1.0,
+        help="Flatten (>1) or sharpen (<1) unigram frequencies: weight = count ** (1 / T)",
+    )
     parser.add_argument('--balance', type=float, default=0.5, help="Ratio of pure language samples (vs _from_ samples)")
     parser.add_argument('--max-phrase-len', type=int, default=3, help="Max words per sample")
     parser.add_argument(
@@ -175,64 +653,72 @@ def main():
         default=None,
         help="Focus generation on a specific layout variant (e.g. he_qwerty). When set, only classes involving that language are generated.",
     )
-    args = parser.parse_args()
-    
-    maps = load_layout_map(args.layouts, focus_layout=args.focus_layout)
-    
+
+def load_word_sources(args):
+    """Fill SEEDS / WORD_WEIGHTS from unigram TSVs and corpus files per the source flags."""
+    seed = getattr(args, 'seed', None)
+
+    # Frequency-weighted words from the shipped unigram lists.
+    corpus_langs = ['ru', 'en', 'he']
+    if args.word_source == 'unigrams':
+        print(f"Loading unigram frequencies from {args.unigrams_dir} (temperature={args.unigram_temperature})...")
+        for lang in ['ru', 'en', 'he']:
+            path = os.path.join(args.unigrams_dir, f"{lang}_unigrams.tsv")
+            if not os.path.exists(path):
+                print(f"  Warning: {path} not found. Falling back to corpus/seeds for {lang}.")
+                continue
+            words, table = load_unigram_words(path, temperature=args.unigram_temperature)
+            if words:
+                SEEDS[lang] = words
+                WORD_WEIGHTS[lang] = table
+                corpus_langs.remove(lang)
+                print(f"  {lang}: {len(words)} weighted words.")
+            else:
+                print(f"  Warning: {path} is empty. Falling back to corpus/seeds for {lang}.")
+
     # Load corpus words if provided
-    if args.corpus_dir:
+    if args.corpus_dir and corpus_langs:
         print(f"Loading corpus from {args.corpus_dir}...")
-        for lang in ['ru', 'en', 'he']:
+        for lang in corpus_langs:
             path = os.path.join(args.corpus_dir, f"{lang}.txt")
             if os.path.exists(path):
                 print(f"  Loading {lang}.txt...", end='', flush=True)
-                with open(path, 'r', encoding='utf-8') as f:
-                    words = []
-                    max_words = args.max_corpus_words or 0
-                    if max_words and args.corpus_sample_mode == 'reservoir':
-                        seen = 0
-                        for line in f:
-                            for p in line.strip().split():
-                                # Include 2-letter words; they're important for HE (e.g. מה, לא) and short EN/RU tokens.
-                                if 2 <= len(p) < 20:
-                                    seen += 1
-                                    if len(words) < max_words:
-                                        words.append(p)
-                                    else:
-                                        j = random.randint(0, seen - 1)
-                                        if j < max_words:
-                                            words[j] = p
+                words = load_corpus_words(
+                    path,
+                    args.max_corpus_words or 0,
+                    args.corpus_sample_mode,
+                    cache_dir=args.corpus_cache_dir or None,
+                    seed=seed,
+                )
+                if words:
+                    SEEDS[lang] = words
+                    if args.max_corpus_words and len(words) >= args.max_corpus_words:
+                        note = "sampled" if args.corpus_sample_mode == 'reservoir' else "capped"
+                        print(f" {len(words)} words loaded ({note}).")
                     else:
-                        # Fast path: take the first N acceptable words.
-                        for line in f:
-                            for p in line.strip().split():
-                                if 2 <= len(p) < 20:
-                                    words.append(p)
-                                    if max_words and len(words) >= max_words:
-                                        break
-                            if max_words and len(words) >= max_words:
-                                break
-                    if words:
-                        SEEDS[lang] = words
-                        if args.max_corpus_words and len(words) >= args.max_corpus_words:
-                            note = "sampled" if args.corpus_sample_mode == 'reservoir' else "capped"
-                            print(f" {len(words)} words loaded ({note}).")
-                        else:
-                            print(f" {len(words)} words loaded.")
-                    else:
-                        print(" Empty or error.")
+                        print(f" {len(words)} words loaded.")
+                else:
+                    print(" Empty or error.")
             else:
                 print(f"  Warning: {path} not found. Using default seeds.")
-    
+
+def select_classes(focus_layout=None, languages=None):
+    """Return (pure_classes, from_classes), narrowed to one language by --focus-layout.
+
+    languages is load_layout_map's {layout id: language}, so a focus layout like
+    hebrew_qwerty resolves to 'he' exactly as for the maps; without it the id prefix is
+    used (he_qwerty -> he).
+    """
     # Balanced class selection
     pure_classes = ['ru', 'en', 'he']
     from_classes = [c for c in CLASSES if '_from_' in c]
 
-    if args.focus_layout:
-        focus = args.focus_layout
-        # Currently only language-specific focus is supported via layout prefix.
-        # Example: he_qwerty -> focus on Hebrew-related classes.
-        focus_lang = focus.split('_', 1)[0] if '_' in focus else focus
+    if focus_layout:
+        # Only language-specific focus is supported: focus on that language's classes.
+        if languages is not None:
+            focus_lang = languages.get(focus_layout)
+        else:
+            focus_lang = focus_layout.split('_', 1)[0] if '_' in focus_layout else focus_layout
         if focus_lang in ['ru', 'en', 'he']:
             pure_classes = [focus_lang]
             focused_from = []
@@ -241,28 +727,135 @@ def main():
                 if intended == focus_lang or typed == focus_lang:
                     focused_from.append(c)
             from_classes = focused_from
-            print(f"Focus mode: {focus} -> classes: pure={pure_classes} from={len(from_classes)}")
+            print(f"Focus mode: {focus_layout} -> classes: pure={pure_classes} from={len(from_classes)}")
         else:
-            print(f"Warning: unknown focus layout '{focus}', ignoring focus mode")
-    
-    with open(args.output, 'w', encoding='utf-8') as f:
-        f.write("text,label\n")
-        for i in range(args.count):
-            # Balance: args.balance chance of pure, (1-args.balance) chance of _from_
-            if random.random() < args.balance:
+            print(f"Warning: unknown focus layout '{focus_layout}', ignoring focus mode")
+    return pure_classes, from_classes
+
+def iter_scalar_batches(maps, pure_classes, from_classes, balance, max_phrase_len, chunk=10000):
+    """Endless (texts, labels) chunks from the scalar per-sample generator."""
+    while True:
+        texts, labels = [], []
+        for _ in range(chunk):
+            # Balance: `balance` chance of pure, (1 - balance) chance of _from_
+            if random.random() < balance:
                 cls = random.choice(pure_classes)
             else:
                 cls = random.choice(from_classes)
-            
-            text, label = generate_sample(cls, maps, args.max_phrase_len)
-            if ',' in text or '"' in text:
-                text = f'"{text.replace(chr(34), chr(34)+chr(34))}"'
-            f.write(f"{text},{label}\n")
-            
-            if (i + 1) % 100000 == 0:
-                print(f"  Generated {i+1}/{args.count}...")
-            
-    print(f"Generated {args.count} samples to {args.output}")
+            text, label = generate_sample(cls, maps, max_phrase_len)
+            texts.append(text)
+            labels.append(label)
+        yield texts, labels
+
+def prepare_sources(args):
+    """Load maps, words and classes for the flags from add_source_args.
+
+    Returns BatchSampler keyword arguments (everything except the seed).
+    """
+    maps, languages, focus_lang = load_layout_map(args.layouts, focus_layout=args.focus_layout, layouts_set=args.layouts_set)
+    load_word_sources(args)
+    pure_classes, from_classes = select_classes(args.focus_layout, languages)
+    class_focus = pure_classes[0] if len(pure_classes) == 1 else None
+    if class_focus != focus_lang:
+        raise ValueError(f"--focus-layout {args.focus_layout}: layout maps focus on {focus_lang}, classes on {class_focus}")
+    return dict(
+        maps=maps,
+        words=SEEDS,
+        pure_classes=pure_classes,
+        from_classes=from_classes,
+        balance=args.balance,
+        max_phrase_len=args.max_phrase_len,
+        word_weights=WORD_WEIGHTS,
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='training_data.csv')
+    parser.add_argument(
+        '--format',
+        choices=['csv', 'tokens'],
+        default='csv',
+        help="'csv' writes text,label rows. 'tokens' writes a memory-mappable pre-tokenized file "
+             "(use a .tok extension) that train.py --data reads without re-tokenizing.",
+    )
+    parser.add_argument('--count', type=int, default=1000000)
+    add_source_args(parser)
+    parser.add_argument(
+        '--sampler',
+        choices=['scalar', 'batch'],
+        default='scalar',
+        help="'scalar' draws one sample at a time with `random`. "
+             "'batch' draws --batch-size samples at once with a NumPy Generator (much faster, same class balance).",
+    )
+    parser.add_argument('--batch-size', type=int, default=65536, help="Samples per draw for --sampler batch")
+    parser.add_argument('--seed', type=int, default=None, help="RNG seed (reproducible datasets)")
+    parser.add_argument('--dedup', action='store_true', help="Drop exact duplicate (text, label) rows")
+    parser.add_argument(
+        '--collisions',
+        choices=['keep', 'drop', 'relabel'],
+        default='keep',
+        help="Rows whose text was already emitted under another label: 'keep' writes them (still reported with --dedup), "
+             "'drop' skips them, 'relabel' rewrites them to the first label seen (dropped as duplicates with --dedup).",
+    )
+    parser.add_argument('--dedup-memory-mb', type=float, default=256, help="Memory budget of the dedup/collision index")
+    parser.add_argument(
+        '--max-draw-factor',
+        type=int,
+        default=20,
+        help="With dedup/collision filtering, give up after drawing count * factor samples",
+    )
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    
+    sources = prepare_sources(args)
+    maps = sources['maps']
+    pure_classes, from_classes = sources['pure_classes'], sources['from_classes']
+
+    index = None
+    if args.dedup or args.collisions != 'keep':
+        index = DedupIndex(
+            pure_classes + from_classes,
+            memory_mb=args.dedup_memory_mb,
+            drop_duplicates=args.dedup,
+            collisions=args.collisions,
+        )
+
+    if args.sampler == 'batch':
+        sampler = BatchSampler(**sources, seed=args.seed)
+        batches = iter(lambda: sampler.sample(args.batch_size), None)
+    else:
+        batches = iter_scalar_batches(maps, pure_classes, from_classes, args.balance, args.max_phrase_len)
+
+    # With dedup enabled, keep drawing until --count rows survive (bounded).
+    max_draws = args.count * args.max_draw_factor
+    done = 0
+    drawn = 0
+    start = time.perf_counter()
+    writer = TokensWriter(args.output) if args.format == 'tokens' else CsvWriter(args.output)
+    for texts, labels in batches:
+        drawn += len(texts)
+        if index is not None:
+            texts, labels = index.filter(texts, labels)
+        n = min(len(texts), args.count - done)
+        writer.write(texts[:n], labels[:n])
+        if (done + n) // 100000 > done // 100000:
+            print(f"  Generated {done+n}/{args.count}...")
+        done += n
+        if done >= args.count:
+            break
+        if index is not None and drawn >= max_draws:
+            print(f"Warning: stopped after {drawn} draws; only {done} unique rows (raise --max-draw-factor or vocabulary size)")
+            break
+    size = writer.close()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    if index is not None:
+        index.report()
+    print(f"Generated {done} samples to {args.output}")
+    print(f"Throughput: {done / elapsed:,.0f} rows/s, {size / elapsed / 1e6:.1f} MB/s "
+          f"({size / 1e6:.1f} MB in {elapsed:.1f}s, sampler={args.sampler}, format={args.format})")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,190 @@
+"""Opt-in per-step timing for the training loops (train.py --step-log, beam_train.py step_log).
+
+Each training step is split into phases by StepTimer.mark() calls; every step becomes one
+JSON line with the phase times (ms), samples/s and peak memory. The device is synchronized
+at every mark so GPU time lands in the phase that queued it, which costs some throughput:
+leave it off for production runs.
+
+Every run starts with a marker line; rerunning with the same log appends, and the summary
+reads only the latest run (--all-runs for everything).
+
+Summarize a log after the run:
+    python instrument.py steps.jsonl [--skip 20]
+"""
+import argparse
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+PHASES = ('data', 'h2d', 'augment', 'forward', 'backward', 'optimizer', 'metrics', 'checkpoint')
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elif device.type == 'mps':
+        torch.mps.synchronize()
+
+def _peak_memory_mb(device):
+    """Peak allocated memory on CUDA, driver-allocated memory on MPS, max RSS on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    if device.type == 'mps':
+        return torch.mps.driver_allocated_memory() / 2**20
+    # ru_maxrss is in bytes on macOS, KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+class StepTimer:
+    """Per-step phase timer writing JSONL; every method is a no-op when log_path is None.
+
+    Optionally records a torch.profiler trace (Chrome trace JSON) of `profile_steps` steps
+    starting at global step `profile_start`.
+    """
+
+    def __init__(self, log_path, device, rank=0, profile_steps=0, profile_start=10, trace_path=None):
+        self.enabled = log_path is not None
+        self.device = device
+        self.rank = rank
+        self.profile_start = profile_start
+        self.profile_end = profile_start + profile_steps if profile_steps else None
+        self.trace_path = trace_path
+        self._profiler = None
+        self._file = open(log_path, 'a') if self.enabled else None
+        if self.enabled:
+            # Run marker: read_step_log() keeps only the rows after the last one.
+            self._file.write(json.dumps({'run_start': time.time(), 'rank': rank}) + "\n")
+        self._times = {}
+        self._last = self._step_start = time.perf_counter()
+
+    def start(self):
+        """Call right before pulling the first batch of an epoch."""
+        if not self.enabled:
+            return
+        _synchronize(self.device)
+        self._last = self._step_start = time.perf_counter()
+
+    def mark(self, phase):
+        """Attribute the time since the previous mark to `phase`."""
+        if not self.enabled:
+            return
+        _synchronize(self.device)
+        now = time.perf_counter()
+        self._times[phase] = self._times.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def end_step(self, epoch, global_step, batch_size):
+        """Write the finished step and start timing the next one (its data wait starts now)."""
+        profiled = self._profiler is not None
+        self._update_profiler(global_step)
+        if not self.enabled:
+            return
+        step_time = self._last - self._step_start
+        row = {
+            'rank': self.rank,
+            'epoch': epoch,
+            'step': global_step,
+            'batch_size': batch_size,
+            'step_ms': 1000 * step_time,
+            **{f'{phase}_ms': 1000 * self._times.get(phase, 0.0) for phase in PHASES},
+            'samples_per_sec': batch_size / step_time if step_time > 0 else None,
+            'peak_mem_mb': _peak_memory_mb(self.device),
+            'profiled': profiled,
+        }
+        self._file.write(json.dumps(row) + "\n")
+        self._times = {}
+        self._step_start = self._last
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _update_profiler(self, global_step):
+        if self.profile_end is None:
+            return
+        if global_step == self.profile_start and self._profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self._profiler.__enter__()
+        elif global_step == self.profile_end and self._profiler is not None:
+            self._finish_profile()
+
+    def _finish_profile(self):
+        self._profiler.__exit__(None, None, None)
+        self._profiler.export_chrome_trace(self.trace_path)
+        print(f"torch.profiler: steps {self.profile_start + 1}-{self.profile_end} written to {self.trace_path} (open in chrome://tracing or Perfetto)")
+        sort_by = "self_cuda_time_total" if self.device.type == 'cuda' else "self_cpu_time_total"
+        print(self._profiler.key_averages().table(sort_by=sort_by, row_limit=15))
+        self._profiler = None
+        self.profile_end = None
+
+    def close(self):
+        if self._profiler is not None:
+            self._finish_profile()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def read_step_log(path, all_runs=False):
+    """Step rows of the latest run in `path` (every run with all_runs; a rerun appends)."""
+    rows, run = [], 0
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if 'run_start' in row:
+                run += 1
+                if not all_runs:
+                    rows = []
+            else:
+                rows.append({**row, 'run': run})
+    return rows
+
+def summarize(rows, skip=10):
+    """Print mean phase times, their share of the step, step-time percentiles and throughput.
+
+    The first `skip` steps of every (run, rank, epoch) are dropped: they include worker start-up,
+    allocator warm-up and torch.compile. Steps run under the torch.profiler are dropped too.
+    """
+    seen = {}
+    kept = []
+    for row in rows:
+        key = (row.get('run', 0), row['rank'], row['epoch'])
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > skip and not row.get('profiled'):
+            kept.append(row)
+    if not kept:
+        print(f"No steps left after skipping {skip} per epoch ({len(rows)} logged)")
+        return
+    step_ms = np.array([row['step_ms'] for row in kept])
+    total_ms = step_ms.sum()
+    samples = sum(row['batch_size'] for row in kept)
+    ranks = sorted({row['rank'] for row in kept})
+    print(f"Step timing: {len(kept)} steps ({len(rows) - len(kept)} warm-up/profiled skipped), ranks {ranks}")
+    print(f"  step ms: mean {step_ms.mean():.2f}  p50 {np.percentile(step_ms, 50):.2f}  "
+          f"p95 {np.percentile(step_ms, 95):.2f}  max {step_ms.max():.2f}")
+    print(f"  throughput: {1000 * samples / total_ms * len(ranks):,.0f} samples/s"
+          f"{' (all ranks)' if len(ranks) > 1 else ''}")
+    print(f"  peak memory: {max(row['peak_mem_mb'] for row in kept):,.0f} MB")
+    shares = []
+    for phase in PHASES:
+        phase_ms = sum(row.get(f'{phase}_ms', 0.0) for row in kept)
+        shares.append((phase_ms / total_ms, phase, phase_ms / len(kept)))
+    for share, phase, mean_ms in shares:
+        print(f"  {phase:10s} {mean_ms:8.2f} ms  {share:6.1%}")
+    print(f"  bottleneck: {max(shares)[1]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a train.py --step-log JSONL file")
+    parser.add_argument('log', nargs='+', help="Step log(s); pass every rank's file for --ddp-cpu runs")
+    parser.add_argument('--skip', type=int, default=10, help="Warm-up steps dropped per epoch and rank")
+    parser.add_argument('--all-runs', action='store_true', help="Summarize every run appended to the log, not just the latest")
+    args = parser.parse_args()
+    rows = [row for path in args.log for row in read_step_log(path, args.all_runs)]
+    summarize(rows, args.skip)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Offline batched inference with a trained train.py checkpoint.
+
+The architecture (v1 / v2 / transformer / ensemble) and its sizes are read from the
+state_dict keys and shapes, so any .pth written by train.py, prune.py or --qat loads
+without flags. Only the transformer head count is not stored in the weights (--nhead).
+
+Usage:
+    echo "ghbdtn" | python predict.py --model_in model.pth
+    python predict.py --model_in model.pth words.txt more_words.txt   # one string per line
+    python predict.py --model_in model.pth --eval training_data.csv   # text,label CSV
+    python predict.py --model_in model.pth --eval ../../tests/test_cases.json
+
+Python:
+    predictor = Predictor.from_checkpoint("model.pth")
+    probs = predictor.predict_proba(["ghbdtn", "hello"])   # [N, len(CLASSES)] numpy array
+"""
+import argparse
+import json
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from train import (
+    LayoutClassifier,
+    LayoutClassifierV2,
+    LayoutTransformer,
+    EnsembleModel,
+    CLASSES,
+    CLASS_TO_IDX,
+    encode_texts,
+    load_state_dict_file,
+)
+
+def detect_architecture(state):
+    """'ensemble', 'transformer', 'v2' or 'v1' from a state_dict's keys."""
+    if 'weight_cnn' in state:
+        return 'ensemble'
+    if 'pos_encoder.pe' in state:
+        return 'transformer'
+    if 'conv3_deep.weight' in state:
+        return 'v2'
+    return 'v1'
+
+def transformer_config(state, nhead=8):
+    """LayoutTransformer kwargs matching a state_dict (nhead cannot be recovered from the weights)."""
+    layers = {int(k.split('.')[2]) for k in state if k.startswith('transformer.layers.')}
+    return {
+        'd_model': state['embedding.weight'].shape[1],
+        'nhead': nhead,
+        'num_layers': len(layers),
+        'dim_feedforward': state['transformer.layers.0.linear1.weight'].shape[0],
+    }
+
+def load_model(path, nhead=8):
+    """Eval-mode model for a checkpoint; returns (model, architecture)."""
+    state = load_state_dict_file(path)
+    arch = detect_architecture(state)
+    if arch == 'ensemble':
+        model = EnsembleModel()
+    elif arch == 'transformer':
+        # nn.TransformerEncoder and the traceable encoder share state_dict keys; the former
+        # has the fused inference fast path.
+        model = LayoutTransformer(**transformer_config(state, nhead))
+    elif arch == 'v2':
+        model = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(state))
+    else:
+        model = LayoutClassifier()
+    model.load_state_dict(state)
+    model.eval()
+    return model, arch
+
+class Predictor:
+    """Batched text -> class probability inference for one model."""
+
+    def __init__(self, model, device="cpu", batch_size=4096):
+        self.model = model.to(device).eval()
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_checkpoint(cls, path, device="cpu", batch_size=4096, nhead=8):
+        model, _ = load_model(path, nhead)
+        return cls(model, device, batch_size)
+
+    def predict_proba(self, texts):
+        """float32 [len(texts), len(CLASSES)] softmax probabilities (first INPUT_LENGTH chars of each text)."""
+        probs = np.empty((len(texts), len(CLASSES)), dtype=np.float32)
+        with torch.inference_mode():
+            for start in range(0, len(texts), self.batch_size):
+                ids = torch.from_numpy(encode_texts(texts[start:start + self.batch_size])).to(self.device)
+                probs[start:start + len(ids)] = torch.softmax(self.model(ids).float(), dim=1).cpu().numpy()
+        return probs
+
+    def predict(self, texts):
+        """Most likely class name of every text."""
+        return [CLASSES[i] for i in self.predict_proba(texts).argmax(axis=1)]
+
+# ============== EVALUATION DATA ==============
+
+SCRIPTS = (('ru', re.compile(r'[а-яёА-ЯЁ]')), ('he', re.compile(r'[א-ת]')), ('en', re.compile(r'[a-zA-Z]')))
+
+def script_language(text):
+    """Language whose letters dominate `text`, or None without letters."""
+    counts = [(len(pattern.findall(text)), lang) for lang, pattern in SCRIPTS]
+    count, lang = max(counts)
+    return lang if count else None
+
+def test_case_label(case):
+    """Class of a test_cases.json {input, expected} pair: 'ru_from_en' when RU text was typed on
+    the EN layout, the plain language when it should stay unchanged; None if neither side has letters."""
+    typed, intended = script_language(case['input']), script_language(case['expected'])
+    if typed is None or intended is None:
+        return None
+    return intended if typed == intended else f"{intended}_from_{typed}"
+
+def load_labeled(path):
+    """(texts, label names) from a text,label CSV or a tests/test_cases.json-style file."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            suites = json.load(f)
+        texts, labels = [], []
+        for suite in suites.values():
+            for case in suite.get('cases', []) if isinstance(suite, dict) else []:
+                if isinstance(case.get('input'), str) and isinstance(case.get('expected'), str):
+                    label = test_case_label(case)
+                    if label in CLASS_TO_IDX:
+                        texts.append(case['input'])
+                        labels.append(label)
+        return texts, labels
+    data = pd.read_csv(path, keep_default_na=False)
+    data = data[data['label'].isin(CLASSES)]
+    return data['text'].astype(str).tolist(), data['label'].tolist()
+
+def evaluate(predictor, texts, labels):
+    """Print accuracy (overall and per class) and end-to-end strings/s, tokenization included."""
+    predictor.predict_proba(texts[:predictor.batch_size])  # warm-up
+    start = time.perf_counter()
+    predicted = predictor.predict(texts)
+    seconds = time.perf_counter() - start
+    correct = np.array(predicted) == np.array(labels)
+    print(f"Accuracy: {100 * correct.mean():.2f}% ({correct.sum()}/{len(labels)})")
+    print(f"Throughput: {len(texts) / seconds:,.0f} strings/s ({1000 * seconds:.1f} ms, batch {predictor.batch_size}, {predictor.device})")
+    for name in CLASSES:
+        mask = np.array(labels) == name
+        if mask.any():
+            print(f"  {name:12s} {100 * correct[mask].mean():6.2f}%  ({mask.sum()})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify strings with a trained checkpoint")
+    parser.add_argument('inputs', nargs='*', help="Text files, one string per line (default: stdin)")
+    parser.add_argument('--model_in', default='model.pth')
+    parser.add_argument('--eval', default=None, help="Score a labeled text,label CSV or test_cases.json instead of classifying inputs")
+    parser.add_argument('--batch_size', type=int, default=4096)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--nhead', type=int, default=8, help="Attention heads of a transformer checkpoint (not stored in the weights)")
+    parser.add_argument('--probs', action='store_true', help="Print every class probability instead of the top class")
+    args = parser.parse_args()
+
+    model, arch = load_model(args.model_in, args.nhead)
+    predictor = Predictor(model, args.device, args.batch_size)
+    print(f"Loaded {args.model_in} ({arch}, {sum(p.numel() for p in model.parameters()):,} params)", file=sys.stderr)
+
+    if args.eval:
+        texts, labels = load_labeled(args.eval)
+        print(f"Evaluating {len(texts)} labeled strings from {args.eval}")
+        evaluate(predictor, texts, labels)
+        return
+
+    texts = []
+    for path in args.inputs or ['-']:
+        f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        texts += [line.rstrip('\n') for line in f]
+        if f is not sys.stdin:
+            f.close()
+    probs = predictor.predict_proba(texts)
+    if args.probs:
+        print("\t".join(['text'] + CLASSES))
+        for text, row in zip(texts, probs):
+            print("\t".join([text] + [f"{p:.4f}" for p in row]))
+    else:
+        for text, row in zip(texts, probs):
+            print(f"{CLASSES[row.argmax()]}\t{row.max():.4f}\t{text}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Structured channel pruning for LayoutClassifierV2.
+
+Ranks the output channels of every conv / hidden fc layer (BatchNorm |gamma| or filter L1 norm),
+physically removes the weakest ones and writes a smaller LayoutClassifierV2 checkpoint that
+train.py --finetune, export.py and validate_export.py load like a full-size one.
+
+Usage:
+    python prune.py --model_in model_v2.pth --model_out model_v2_pruned.pth --ratio 0.5 --data training_data.csv
+"""
+import argparse
+
+import torch
+
+from train import (
+    LayoutClassifierV2,
+    TensorLayoutDataset,
+    TOKENIZED_SUFFIX,
+    INPUT_LENGTH,
+    VOCAB_SIZE,
+    batch1_latency_ms,
+    build_arg_parser,
+    evaluate_accuracy,
+    load_state_dict_file,
+    train,
+    train_val_split,
+)
+
+# BatchNorm -> the convs whose outputs it normalizes, in concatenation order.
+CONV_GROUPS = {
+    'bn1': ('conv2', 'conv3', 'conv4', 'conv5'),
+    'bn2': ('conv2_a', 'conv2_b'),
+    'bn3': ('conv3_deep',),
+}
+
+def channel_scores(model, criterion):
+    """{layer: importance of each output channel} for LayoutClassifierV2.WIDTH_LAYERS.
+
+    'bn' uses |gamma| of the BatchNorm channel the conv feeds (fc layers have no BatchNorm
+    and always use L1); 'l1' uses the L1 norm of each output filter.
+    """
+    scores = {}
+    for bn_name, layers in CONV_GROUPS.items():
+        gamma = getattr(model, bn_name).weight.detach().abs()
+        offset = 0
+        for name in layers:
+            weight = getattr(model, name).weight.detach()
+            width = weight.shape[0]
+            if criterion == 'bn':
+                scores[name] = gamma[offset:offset + width]
+            else:
+                scores[name] = weight.abs().sum(dim=(1, 2))
+            offset += width
+    for name in ('fc1', 'fc2'):
+        scores[name] = getattr(model, name).weight.detach().abs().sum(dim=1)
+    return scores
+
+def select_channels(scores, ratio):
+    """Sorted indices of the channels to keep: the top (1 - ratio) of every layer, at least one."""
+    keep = {}
+    for name, score in scores.items():
+        count = max(1, round(len(score) * (1 - ratio)))
+        keep[name] = torch.topk(score, count).indices.sort().values
+    return keep
+
+def _concat(parts):
+    """Indices into a concatenation of [(kept indices, full width), ...]."""
+    offset, indices = 0, []
+    for keep, width in parts:
+        indices.append(keep + offset)
+        offset += width
+    return torch.cat(indices)
+
+def _dropped(keep, width):
+    mask = torch.ones(width, dtype=torch.bool)
+    mask[keep] = False
+    return mask
+
+def prune_v2(model, keep):
+    """New, smaller LayoutClassifierV2 holding the kept channels of `model`.
+
+    A removed BatchNorm channel is replaced by its mean output (beta), folded into the
+    next layer's bias; this is exact for fc1 and ignores only the zero-padded border
+    positions of the convs.
+    """
+    old = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    widths = {name: len(idx) for name, idx in keep.items()}
+    pruned = LayoutClassifierV2(embedding_dim=old['embedding.weight'].shape[1], widths=widths)
+    full = {name: getattr(model, name).weight.shape[0] for name in keep}
+    new = {'embedding.weight': old['embedding.weight']}
+
+    def take_bn(name, idx):
+        for key in ('weight', 'bias', 'running_mean', 'running_var'):
+            new[f'{name}.{key}'] = old[f'{name}.{key}'][idx]
+        new[f'{name}.num_batches_tracked'] = old[f'{name}.num_batches_tracked']
+
+    def take_layer(name, out_idx, in_idx=None, fold_beta=None):
+        weight = old[f'{name}.weight']
+        bias = old[f'{name}.bias'][out_idx]
+        if fold_beta is not None:
+            # Input channels dropped by the previous BatchNorm: fold their constant beta into the bias.
+            dropped = _dropped(in_idx, weight.shape[1])
+            contribution = weight[:, dropped] * fold_beta[dropped].view(-1, *([1] * (weight.dim() - 2)))
+            bias = bias + contribution.flatten(1).sum(1)[out_idx]
+        if in_idx is not None:
+            weight = weight[:, in_idx]
+        new[f'{name}.weight'] = weight[out_idx]
+        new[f'{name}.bias'] = bias
+
+    for name in CONV_GROUPS['bn1']:
+        take_layer(name, keep[name])
+    bn1_idx = _concat([(keep[n], full[n]) for n in CONV_GROUPS['bn1']])
+    take_bn('bn1', bn1_idx)
+
+    for name in CONV_GROUPS['bn2']:
+        take_layer(name, keep[name], bn1_idx, fold_beta=old['bn1.bias'])
+    bn2_idx = _concat([(keep[n], full[n]) for n in CONV_GROUPS['bn2']])
+    take_bn('bn2', bn2_idx)
+
+    take_layer('conv3_deep', keep['conv3_deep'], bn2_idx, fold_beta=old['bn2.bias'])
+    take_bn('bn3', keep['conv3_deep'])
+
+    # fc1 sees [max_pool, avg_pool] of bn3: both equal beta for a constant channel.
+    deep = full['conv3_deep']
+    fc1_in = _concat([(keep['conv3_deep'], deep), (keep['conv3_deep'], deep)])
+    take_layer('fc1', keep['fc1'], fc1_in, fold_beta=old['bn3.bias'].repeat(2))
+    take_layer('fc2', keep['fc2'], keep['fc1'])
+    take_layer('fc3', torch.arange(old['fc3.weight'].shape[0]), keep['fc2'])
+
+    pruned.load_state_dict(new)
+    return pruned
+
+def load_val_dataset(data, seed, token_cache_dir):
+    """The validation split train.py uses for --data with --seed."""
+    if data.endswith(TOKENIZED_SUFFIX):
+        full_dataset = TensorLayoutDataset.from_tokenized(data)
+    else:
+        full_dataset = TensorLayoutDataset.from_csv(data, cache_dir=token_cache_dir)
+    _, val_indices = train_val_split(len(full_dataset), seed)
+    return full_dataset.subset(val_indices)
+
+def describe(model, val_dataset):
+    params = sum(p.numel() for p in model.parameters())
+    acc = evaluate_accuracy(model, val_dataset, "cpu") if val_dataset is not None else None
+    return params, acc, batch1_latency_ms(model)
+
+def report(rows):
+    print("\nPruning report (CPU batch-1 latency)")
+    base_params, _, base_latency = rows[0][1]
+    for name, (params, acc, latency) in rows:
+        acc_text = f"acc {acc:6.2f}%  " if acc is not None else ""
+        print(f"  {name:10s} {acc_text}params {params:>10,} ({params / base_params:5.1%})  "
+              f"latency {latency:.3f} ms ({base_latency / latency:.2f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Structured channel pruning of a LayoutClassifierV2 checkpoint")
+    parser.add_argument('--model_in', required=True, help="Trained LayoutClassifierV2 state_dict (train.py --model_v2)")
+    parser.add_argument('--model_out', default='model_v2_pruned.pth')
+    parser.add_argument('--criterion', choices=['bn', 'l1'], default='bn', help="Rank conv channels by BatchNorm |gamma| or filter L1 norm")
+    parser.add_argument('--ratio', type=float, default=0.5, help="Fraction of channels removed from every conv / hidden fc layer")
+    parser.add_argument('--data', default=None, help="Dataset for accuracy and recovery fine-tuning (CSV or .tok); without it only params/latency are reported")
+    parser.add_argument('--seed', type=int, default=0, help="train.py --seed: must match the original run for a clean validation split")
+    parser.add_argument('--epochs', type=int, default=5, help="Fine-tune epochs after pruning (0: prune only)")
+    parser.add_argument('--lr', type=float, default=0.0003)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--token-cache-dir', default='.token_cache')
+    args = parser.parse_args()
+    if not 0 <= args.ratio < 1:
+        parser.error("--ratio must be in [0, 1)")
+
+    state = load_state_dict_file(args.model_in)
+    model = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(state))
+    model.load_state_dict(state)
+    model.eval()
+
+    keep = select_channels(channel_scores(model, args.criterion), args.ratio)
+    pruned = prune_v2(model, keep).eval()
+    print(f"Pruned {args.ratio:.0%} of channels by {args.criterion}: "
+          + ", ".join(f"{name} {getattr(model, name).weight.shape[0]}->{len(idx)}" for name, idx in keep.items()))
+    # export.py traces the model; make sure the pruned graph still does.
+    torch.jit.trace(pruned, torch.randint(0, VOCAB_SIZE, (1, INPUT_LENGTH), dtype=torch.long))
+    torch.save(pruned.state_dict(), args.model_out)
+    print(f"Pruned model saved to {args.model_out}")
+
+    val_dataset = load_val_dataset(args.data, args.seed, args.token_cache_dir) if args.data else None
+    rows = [("original", describe(model, val_dataset)), ("pruned", describe(pruned, val_dataset))]
+
+    if args.data and args.epochs > 0:
+        print(f"\nFine-tuning the pruned model for {args.epochs} epochs")
+        train_args = build_arg_parser().parse_args([
+            '--data', args.data, '--model_v2', '--finetune',
+            '--model_in', args.model_out, '--model_out', args.model_out,
+            '--epochs', str(args.epochs), '--lr', str(args.lr), '--batch_size', str(args.batch_size),
+            '--seed', str(args.seed), '--token-cache-dir', args.token_cache_dir,
+            '--checkpoint', f"{args.model_out}.ckpt",
+        ])
+        train(train_args)
+        finetuned = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(load_state_dict_file(args.model_out)))
+        finetuned.load_state_dict(load_state_dict_file(args.model_out))
+        rows.append(("fine-tuned", describe(finetuned, val_dataset)))
+
+    report(rows)
+    print(f"Export with: python export.py --model_v2 --model_in {args.model_out}")
+
+if __name__ == "__main__":
+    main()
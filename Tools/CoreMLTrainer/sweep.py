@@ -0,0 +1,198 @@
+"""Parallel hyperparameter sweep over train.py with successive halving.
+
+Trials are train.py runs (same flags, see DEFAULT_SPACE) executed in a process pool; each
+pool process is pinned to its own set of CPU cores. The dataset is tokenized once into a
+.tok file that every trial memory-maps, so the page cache holds a single copy.
+
+Successive halving: every trial trains for --min-epochs, the best 1/--eta continue to
+eta x as many epochs (resuming from their training-state checkpoint), and so on up to
+--max-epochs. The leaderboard (accuracy, params, batch-1 CPU latency) is written to
+<sweep_dir>/leaderboard.csv.
+
+Usage:
+    python sweep.py --data training_data.csv --trials 12 --min-epochs 1 --max-epochs 9
+    python sweep.py --data training_data.csv --space space.json   # {"flag": [values, ...], ...}
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import torch
+
+from train import (
+    TensorLayoutDataset,
+    TOKENIZED_SUFFIX,
+    batch1_latency_ms,
+    build_arg_parser,
+    build_model,
+    load_state_dict_file,
+    train,
+)
+
+# train.py flag -> candidate values. 'model' picks the architecture; flags that do not
+# apply to it (e.g. nhead for v2) are dropped, so equivalent configs are only run once.
+DEFAULT_SPACE = {
+    'model': ['v2', 'transformer'],
+    'hidden_dim': [192, 256, 384],
+    'd_model': [64, 128],
+    'nhead': [4, 8],
+    'lr': [0.0003, 0.001, 0.003],
+    'augment': [False, True],
+    'mixup': [False, True],
+}
+MODEL_FLAGS = {
+    'v1': [],
+    'v2': ['hidden_dim', 'embedding_dim'],
+    'transformer': ['d_model', 'nhead', 'num_layers'],
+    'ensemble': [],
+}
+TRAINING_FLAGS = ['lr', 'batch_size', 'augment', 'mixup', 'hard_examples']
+
+def expand_space(space, trials, seed):
+    """Distinct trial configs: the whole grid, or `trials` of them drawn at random."""
+    keys = list(space)
+    configs, seen = [], set()
+    for values in itertools.product(*(space[k] for k in keys)):
+        config = dict(zip(keys, values))
+        model = config.get('model', 'v2')
+        config = {k: v for k, v in config.items() if k == 'model' or k in MODEL_FLAGS[model] or k in TRAINING_FLAGS}
+        key = json.dumps(config, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            configs.append(config)
+    if trials and trials < len(configs):
+        configs = random.Random(seed).sample(configs, trials)
+    return configs
+
+def train_argv(config, data, epochs, trial_dir, seed):
+    """train.py command line of one trial (resumable, so later rungs continue training)."""
+    argv = [
+        '--data', data, '--epochs', str(epochs), '--seed', str(seed),
+        '--model_out', os.path.join(trial_dir, 'model.pth'),
+        '--checkpoint', os.path.join(trial_dir, 'state.ckpt'), '--checkpoint-every', '0', '--resume',
+    ]
+    model = config.get('model', 'v2')
+    if model == 'v2':
+        argv.append('--model_v2')
+    elif model != 'v1':
+        argv.append(f'--{model}')
+    for key, value in config.items():
+        if key == 'model':
+            continue
+        flag = '--' + (key if key == 'batch_size' else key.replace('_', '-'))
+        if isinstance(value, bool):
+            argv += [flag] if value else []
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+def _pin_worker(core_sets):
+    """Pool initializer: claim one core set, pin this process to it and size torch's thread pool."""
+    cores = core_sets.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+def run_trial(trial_id, config, data, epochs, trial_dir, seed):
+    """Train one trial up to `epochs` epochs; returns (trial_id, best val accuracy, seconds)."""
+    os.makedirs(trial_dir, exist_ok=True)
+    args = build_arg_parser().parse_args(train_argv(config, data, epochs, trial_dir, seed))
+    start = time.perf_counter()
+    with open(os.path.join(trial_dir, 'train.log'), 'a') as log, contextlib.redirect_stdout(log):
+        print(f"=== {epochs} epochs: {json.dumps(config)}")
+        val_acc = train(args)
+    return trial_id, val_acc, time.perf_counter() - start
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    budgets = [min_epochs]
+    while budgets[-1] * eta <= max_epochs:
+        budgets.append(budgets[-1] * eta)
+    return budgets
+
+def measure(config, trial_dir, seed):
+    """Params and batch-1 CPU latency of a trial's best checkpoint (run in the main process, one thread)."""
+    args = build_arg_parser().parse_args(train_argv(config, 'unused', 1, trial_dir, seed))
+    model, _ = build_model(args)
+    model.load_state_dict(load_state_dict_file(args.model_out))
+    return sum(p.numel() for p in model.parameters()), batch1_latency_ms(model)
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel successive-halving sweep over train.py flags")
+    parser.add_argument('--data', required=True, help=f"Training CSV or {TOKENIZED_SUFFIX} file (tokenized once, shared by all trials)")
+    parser.add_argument('--space', default=None, help="JSON search space {train.py flag: [values]} (default: DEFAULT_SPACE)")
+    parser.add_argument('--trials', type=int, default=12, help="Random trials drawn from the space (0: the full grid)")
+    parser.add_argument('--min-epochs', type=int, default=1, help="Epochs of the first rung")
+    parser.add_argument('--max-epochs', type=int, default=9, help="Epoch budget of the last rung")
+    parser.add_argument('--eta', type=int, default=3, help="Keep the best 1/eta trials per rung; the next rung trains eta x longer")
+    parser.add_argument('--cores-per-trial', type=int, default=None, help="CPU cores pinned per trial (default: cores / --workers)")
+    parser.add_argument('--workers', type=int, default=None, help="Trials run in parallel (default: cores / 2, at least 1)")
+    parser.add_argument('--sweep-dir', default='sweep', help="Trial checkpoints, logs and leaderboard.csv")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for trial sampling and every trial's split / init")
+    parser.add_argument('--token-cache-dir', default='.token_cache', help="Where the shared .tok copy of a --data CSV is written")
+    args = parser.parse_args()
+    if not args.token_cache_dir and not args.data.endswith(TOKENIZED_SUFFIX):
+        parser.error("--token-cache-dir is required for CSV --data: trials share its .tok file")
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    workers = args.workers or max(1, len(cores) // (args.cores_per_trial or 2))
+    per_trial = args.cores_per_trial or max(1, len(cores) // workers)
+    workers = max(1, min(workers, len(cores) // per_trial))
+    if not hasattr(os, 'sched_setaffinity'):
+        print("Core pinning is not available on this OS; trials only get --cores-per-trial torch threads")
+
+    # Tokenize once; every trial memory-maps the same .tok file.
+    data = args.data
+    if not data.endswith(TOKENIZED_SUFFIX):
+        data = TensorLayoutDataset.from_csv(data, cache_dir=args.token_cache_dir).path
+    space = DEFAULT_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    configs = expand_space(space, args.trials, args.seed)
+    budgets = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    print(f"Sweep: {len(configs)} trials, rungs {budgets} epochs, {workers} workers x {per_trial} cores, data {data}")
+
+    results = {i: {'trial': i, 'model': c.get('model', 'v2'), 'config': json.dumps(c), 'val_acc': None, 'epochs': 0, 'train_seconds': 0.0}
+               for i, c in enumerate(configs)}
+    ctx = mp.get_context('spawn')
+    core_sets = ctx.Queue()
+    for w in range(workers):
+        core_sets.put(cores[w * per_trial:(w + 1) * per_trial])
+    alive = list(range(len(configs)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_pin_worker, initargs=(core_sets,)) as pool:
+        for rung, epochs in enumerate(budgets):
+            start = time.perf_counter()
+            futures = [
+                pool.submit(run_trial, i, configs[i], data, epochs, os.path.join(args.sweep_dir, f"trial_{i:03d}"), args.seed)
+                for i in alive
+            ]
+            for future in futures:
+                trial_id, val_acc, seconds = future.result()
+                results[trial_id].update(val_acc=val_acc, epochs=epochs)
+                results[trial_id]['train_seconds'] += seconds
+            alive.sort(key=lambda i: results[i]['val_acc'], reverse=True)
+            print(f"Rung {rung + 1} ({epochs} epochs, {len(alive)} trials, {time.perf_counter() - start:.0f}s): "
+                  + ", ".join(f"#{i} {results[i]['val_acc']:.2f}%" for i in alive))
+            alive = alive[:max(1, math.ceil(len(alive) / args.eta))]
+
+    torch.set_num_threads(1)
+    for i, config in enumerate(configs):
+        params, latency = measure(config, os.path.join(args.sweep_dir, f"trial_{i:03d}"), args.seed)
+        results[i].update(params=params, latency_ms=round(latency, 3))
+    leaderboard = pd.DataFrame(results.values()).sort_values(['epochs', 'val_acc'], ascending=False)
+    path = os.path.join(args.sweep_dir, 'leaderboard.csv')
+    leaderboard.to_csv(path, index=False)
+    print(f"\nLeaderboard ({path}; latency: CPU batch 1, 1 thread):")
+    print(leaderboard[['trial', 'model', 'epochs', 'val_acc', 'params', 'latency_ms', 'config']].head(10).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
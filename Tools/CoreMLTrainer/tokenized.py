@@ -0,0 +1,92 @@
+"""Pre-tokenized dataset files (`.tok`), written by generate_data.py --format tokens.
+
+Layout (little-endian):
+    [HEADER_SIZE bytes]  magic + JSON header (n, input_length, dtypes, tokenizer hash)
+    [n * INPUT_LENGTH]   token ids, uint8 when VOCAB_SIZE fits, else uint16
+    [n]                  label ids (index into CLASSES), uint8
+
+Both arrays are memory-mappable with numpy.memmap, so readers never parse text.
+"""
+import json
+import os
+
+import numpy as np
+
+from vocab import CLASSES, INPUT_LENGTH, VOCAB_SIZE, tokenizer_hash
+
+MAGIC = b"OMFKTOK1"
+HEADER_SIZE = 4096
+TOKENIZED_SUFFIX = ".tok"
+IDS_DTYPE = np.uint8 if VOCAB_SIZE <= 256 else np.uint16
+LABELS_DTYPE = np.uint8
+
+class TokenizedWriter:
+    """Streams id rows to disk; labels are buffered and appended on close()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._labels = bytearray()
+        self._f = open(path, 'wb')
+        self._f.write(b"\0" * HEADER_SIZE)
+
+    def write(self, ids, labels):
+        """Append ids ([n, INPUT_LENGTH] ints) and labels (n label ids)."""
+        ids = np.asarray(ids)
+        if ids.ndim != 2 or ids.shape[1] != INPUT_LENGTH:
+            raise ValueError(f"expected [n, {INPUT_LENGTH}] ids, got {ids.shape}")
+        self._f.write(np.ascontiguousarray(ids, dtype=IDS_DTYPE).tobytes())
+        self._labels += np.asarray(labels, dtype=LABELS_DTYPE).tobytes()
+        self.count += len(ids)
+
+    def close(self):
+        self._f.write(self._labels)
+        header = json.dumps({
+            'n': self.count,
+            'input_length': INPUT_LENGTH,
+            'ids_dtype': np.dtype(IDS_DTYPE).str,
+            'labels_dtype': np.dtype(LABELS_DTYPE).str,
+            'tokenizer_hash': tokenizer_hash(),
+            'classes': CLASSES,
+        }).encode('utf-8')
+        if len(MAGIC) + 4 + len(header) > HEADER_SIZE:
+            raise ValueError("tokenized header does not fit")
+        self._f.seek(0)
+        self._f.write(MAGIC + len(header).to_bytes(4, 'little') + header)
+        self._f.close()
+        return os.path.getsize(self.path)
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    if head[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path}: not a tokenized dataset (bad magic)")
+    size = int.from_bytes(head[len(MAGIC):len(MAGIC) + 4], 'little')
+    return json.loads(head[len(MAGIC) + 4:len(MAGIC) + 4 + size].decode('utf-8'))
+
+def open_tokenized(path, mode='r'):
+    """Memory-map a .tok file; returns (ids [n, INPUT_LENGTH], labels [n]).
+
+    mode is passed to numpy.memmap; 'c' (copy-on-write) gives writable arrays
+    that still share unmodified pages with the file.
+
+    Raises ValueError if the file was produced with a different ALPHABET,
+    INPUT_LENGTH or class list than the current vocab.py.
+    """
+    header = read_header(path)
+    if header['tokenizer_hash'] != tokenizer_hash():
+        raise ValueError(
+            f"{path}: tokenizer mismatch (file hash {header['tokenizer_hash'][:12]}, "
+            f"current {tokenizer_hash()[:12]}); regenerate the dataset"
+        )
+    n = header['n']
+    ids_dtype = np.dtype(header['ids_dtype'])
+    ids = np.memmap(path, dtype=ids_dtype, mode=mode, offset=HEADER_SIZE, shape=(n, INPUT_LENGTH))
+    labels = np.memmap(
+        path,
+        dtype=np.dtype(header['labels_dtype']),
+        mode=mode,
+        offset=HEADER_SIZE + n * INPUT_LENGTH * ids_dtype.itemsize,
+        shape=(n,),
+    )
+    return ids, labels
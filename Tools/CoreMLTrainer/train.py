@@ -1,7 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.nn.utils import parametrize
+from torch.ao.quantization import FakeQuantize, MovingAverageMinMaxObserver, MovingAveragePerChannelMinMaxObserver
+from torch.utils.data import Dataset, DataLoader, IterableDataset, Sampler, get_worker_info
 import pandas as pd
 import numpy as np
 import argparse
@@ -9,22 +14,25 @@ import os
 import random
 import math
 import copy
+import time
+import itertools
+import socket
+import sys
 
-# Constants
-INPUT_LENGTH = 20
-ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890 -=[]\\;',./`!@#$%^&*()_+{}|:\"<>?~"
-ALPHABET += "абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
-ALPHABET += "אבגדהוזחטיכלמנסעפצקרשתךםןףץ"
-CHAR_TO_IDX = {c: i+1 for i, c in enumerate(ALPHABET)}
-VOCAB_SIZE = len(ALPHABET) + 1
-
-CLASSES = [
-    'ru', 'en', 'he',
-    'ru_from_en', 'he_from_en',
-    'en_from_ru', 'en_from_he',
-    'he_from_ru', 'ru_from_he'
-]
-CLASS_TO_IDX = {c: i for i, c in enumerate(CLASSES)}
+import generate_data
+
+from vocab import (
+    INPUT_LENGTH,
+    ALPHABET,
+    CHAR_TO_IDX,
+    VOCAB_SIZE,
+    CLASSES,
+    CLASS_TO_IDX,
+    encode_texts,
+    tokenizer_hash,
+)
+from instrument import StepTimer, read_step_log, summarize
+from tokenized import TOKENIZED_SUFFIX, IDS_DTYPE, LABELS_DTYPE, TokenizedWriter, open_tokenized
 
 # ============== DATA AUGMENTATION ==============
 
@@ -73,6 +81,78 @@ def augment_text(text, aug_prob=0.15):
     
     return ''.join(text)
 
+_AUG_TABLES = {}
+
+def _augment_tables(device):
+    """Per-token lookup tables for augment_ids: swapcase id, isalpha, ord-1/ord+1 neighbor ids."""
+    if device not in _AUG_TABLES:
+        swapcase = torch.arange(VOCAB_SIZE)
+        is_alpha = torch.zeros(VOCAB_SIZE, dtype=torch.bool)
+        neighbor = torch.zeros(VOCAB_SIZE, 2, dtype=torch.long)
+        for c, i in CHAR_TO_IDX.items():
+            swapcase[i] = CHAR_TO_IDX.get(c.swapcase(), 0) if len(c.swapcase()) == 1 else i
+            is_alpha[i] = c.isalpha()
+            neighbor[i, 0] = CHAR_TO_IDX.get(chr(ord(c) - 1), 0)
+            neighbor[i, 1] = CHAR_TO_IDX.get(chr(ord(c) + 1), 0)
+        _AUG_TABLES[device] = (swapcase.to(device), is_alpha.to(device), neighbor.to(device))
+    return _AUG_TABLES[device]
+
+def augment_ids(ids, aug_prob=0.15):
+    """Batched augment_text over a [B, INPUT_LENGTH] tensor of token ids, on its own device.
+
+    Each row is augmented with probability aug_prob by one of the same five families
+    (typo, case, swap, delete, duplicate), picked uniformly. Works on the (truncated) ids,
+    so deleting near the end pads instead of pulling in characters past INPUT_LENGTH.
+    """
+    length = ids.shape[1]
+    device = ids.device
+    swapcase, is_alpha, neighbor = _augment_tables(device)
+    out = ids.clone()
+    # Only the selected rows (aug_prob of the batch) go through the augmentation ops.
+    picked = torch.nonzero(torch.rand(len(ids), device=device) < aug_prob).squeeze(1)
+    sub = ids[picked]
+    batch = len(sub)
+    positions = torch.arange(length, device=device).expand(batch, length)
+    lengths = ((sub > 0) * (positions + 1)).amax(dim=1)
+    kind = torch.randint(0, 5, (batch,), device=device).masked_fill(lengths < 2, -1)
+    u = torch.rand(batch, device=device)
+    idx = (u * lengths).long().clamp(max=length - 1)
+    rows = torch.arange(batch, device=device)
+    aug = sub.clone()
+
+    # typo: swap case or shift the code point by one, letters only
+    at = sub[rows, idx]
+    typo = (kind == 0) & is_alpha[at]
+    shifted = neighbor[at, torch.randint(0, 2, (batch,), device=device)]
+    replacement = torch.where(torch.rand(batch, device=device) < 0.5, swapcase[at], shifted)
+    aug[rows[typo], idx[typo]] = replacement[typo]
+
+    # case: flip each character with probability 0.3
+    flip = ((kind == 1)[:, None]
+            & (torch.rand(batch, length, device=device) < 0.3)
+            & (positions < lengths[:, None]))
+    aug = torch.where(flip, swapcase[aug], aug)
+
+    # swap: exchange two adjacent characters
+    swap = kind == 2
+    left = (u * (lengths - 1)).long()
+    r, i = rows[swap], left[swap]
+    aug[r, i], aug[r, i + 1] = sub[r, i + 1], sub[r, i]
+
+    # delete: drop one character, shift the tail left
+    delete = (kind == 3) & (lengths > 2)
+    source = positions + (positions >= idx[:, None]).long()
+    dropped = sub.gather(1, source.clamp(max=length - 1)).masked_fill(source >= length, 0)
+    aug = torch.where(delete[:, None], dropped, aug)
+
+    # duplicate: repeat one character, shift the tail right (truncating)
+    duplicate = kind == 4
+    source = positions - (positions > idx[:, None]).long()
+    aug = torch.where(duplicate[:, None], sub.gather(1, source), aug)
+
+    out[picked] = aug
+    return out
+
 class LayoutDataset(Dataset):
     def __init__(self, csv_file, augment=False):
         self.data = pd.read_csv(csv_file)
@@ -99,6 +179,281 @@ class LayoutDataset(Dataset):
             
         return torch.tensor(indices, dtype=torch.long), torch.tensor(CLASS_TO_IDX[label_str], dtype=torch.long)
 
+class TensorLayoutDataset(Dataset):
+    """Whole dataset tokenized once into a contiguous [N, INPUT_LENGTH] id array.
+
+    Indexed by batches, not items: __getitem__ takes a tensor of row indices (from
+    BatchSliceSampler) and gathers the batch with one fancy-indexing op, so use it with
+    DataLoader(batch_size=None). `rows` restricts the dataset to a split without copying.
+    Datasets backed by a .tok file (`path`) are memory-mapped and pickle without their
+    arrays, so worker processes re-map the file instead of receiving copies.
+    Optional `soft_targets` (per-row teacher logits, see --distill-from) are returned
+    as a third batch element.
+    """
+    def __init__(self, ids=None, labels=None, rows=None, path=None, soft_targets=None):
+        self.ids = ids
+        self.labels = labels
+        self.rows = rows
+        self.path = path
+        self.soft_targets = soft_targets
+        if path is not None and ids is None:
+            self._map()
+
+    def _map(self):
+        # Copy-on-write mapping: writable for torch, but pages stay shared with the page cache.
+        ids, labels = open_tokenized(self.path, mode='c')
+        self.ids = torch.from_numpy(ids)
+        self.labels = torch.from_numpy(labels)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['ids'] = None
+            state['labels'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self._map()
+
+    @staticmethod
+    def _tokenize_csv(csv_file, chunk_size=1_000_000):
+        data = pd.read_csv(csv_file)
+        data = data[data['label'].isin(CLASSES)]
+        texts = data['text'].astype(str).to_numpy()
+        ids = np.empty((len(texts), INPUT_LENGTH), dtype=IDS_DTYPE)
+        for start in range(0, len(texts), chunk_size):
+            ids[start:start + chunk_size] = encode_texts(texts[start:start + chunk_size])
+        labels = data['label'].map(CLASS_TO_IDX).to_numpy(dtype=LABELS_DTYPE)
+        return ids, labels
+
+    @classmethod
+    def from_csv(cls, csv_file, cache_dir=None):
+        """Parse and tokenize a CSV.
+
+        With cache_dir, the result is stored once as a .tok file keyed by the CSV content
+        hash and tokenizer_hash(); later loads map that file instead of parsing the CSV.
+        """
+        if not cache_dir:
+            ids, labels = cls._tokenize_csv(csv_file)
+            return cls(torch.from_numpy(ids), torch.from_numpy(labels))
+        key = f"{generate_data.file_digest(csv_file)}-{tokenizer_hash()[:12]}"
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(csv_file)}.{key}{TOKENIZED_SUFFIX}")
+        if os.path.exists(cache_path):
+            print(f"Using tokenized cache {cache_path}")
+        else:
+            ids, labels = cls._tokenize_csv(csv_file)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            writer = TokenizedWriter(tmp_path)
+            writer.write(ids, labels)
+            writer.close()
+            os.replace(tmp_path, cache_path)
+            print(f"Cached tokenized dataset to {cache_path}")
+        return cls.from_tokenized(cache_path)
+
+    @classmethod
+    def from_tokenized(cls, path):
+        return cls(path=path)
+
+    def subset(self, indices, soft_targets=None):
+        """Split view sharing the id/label storage; soft_targets are indexed by full-dataset row."""
+        rows = torch.as_tensor(indices, dtype=torch.long)
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return TensorLayoutDataset(self.ids, self.labels, rows, self.path, soft_targets)
+
+    def __len__(self):
+        return len(self.ids) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, batch):
+        if self.rows is not None:
+            batch = self.rows[batch]
+        if self.soft_targets is not None:
+            return self.ids[batch].long(), self.labels[batch].long(), self.soft_targets[batch].float()
+        return self.ids[batch].long(), self.labels[batch].long()
+
+class BatchSliceSampler(Sampler):
+    """Yields whole batches as index tensors: one permutation per epoch, cut into slices.
+
+    With a seed, the permutation depends only on (seed, epoch) (see set_epoch), so a
+    resumed run replays the same batch order. num_replicas/rank shard the permutation
+    the way DistributedSampler does: with pad=True it wraps around so every rank gets
+    the same number of batches; pad=False gives exact, uneven shards for evaluation.
+    """
+    def __init__(self, num_samples, batch_size, shuffle=True, seed=None, num_replicas=1, rank=0, pad=True):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard_size(self):
+        if self.pad:
+            return math.ceil(self.num_samples / self.num_replicas)
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
+    def __len__(self):
+        return math.ceil(self._shard_size() / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle and self.seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(int(np.random.SeedSequence([self.seed, self.epoch]).generate_state(1)[0]))
+            order = torch.randperm(self.num_samples, generator=generator)
+        elif self.shuffle:
+            order = torch.randperm(self.num_samples)
+        else:
+            order = torch.arange(self.num_samples)
+        if self.num_replicas > 1:
+            if self.pad:
+                padding = self._shard_size() * self.num_replicas - self.num_samples
+                order = torch.cat([order, order[:padding]])
+            order = order[self.rank::self.num_replicas]
+        return iter(order.split(self.batch_size))
+
+class HardExampleSampler(Sampler):
+    """Loss-aware batch sampler: each epoch oversamples the rows the model currently gets wrong.
+
+    Keeps an exponential moving average of every row's loss (update(), rows start at the
+    loss of a uniform guess; rows are visited about once per epoch, hence the low momentum). Each epoch draws len(dataset) rows with replacement from
+    p = (1 - uniform) * ema / sum(ema) + uniform / N, so easy rows are still revisited, and
+    importance_weights() = 1 / (N p) keeps the weighted loss an unbiased estimate of the
+    uniform one. Batches depend only on (seed, epoch) and the EMA at the start of the epoch,
+    so like BatchSliceSampler a resumed run (with load_state_dict) replays them exactly.
+    """
+    def __init__(self, num_samples, batch_size, seed=None, uniform=0.3, momentum=0.5):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.seed = seed
+        self.uniform = uniform
+        self.momentum = momentum
+        self.loss_ema = torch.full((num_samples,), math.log(len(CLASSES)))
+        self.epoch = 0
+        self.probs = None
+        self.probs_epoch = None
+        self._order = None
+
+    def set_epoch(self, epoch):
+        """Fix the epoch's draw probabilities from the current loss EMA (kept when resuming mid-epoch)."""
+        self.epoch = epoch
+        if self.probs_epoch != epoch:
+            ema = self.loss_ema.double()
+            self.probs = (1 - self.uniform) * ema / ema.sum() + self.uniform / self.num_samples
+            self.probs_epoch = epoch
+
+    def __len__(self):
+        return math.ceil(self.num_samples / self.batch_size)
+
+    def __iter__(self):
+        if self.probs_epoch != self.epoch:
+            self.set_epoch(self.epoch)
+        generator = torch.Generator()
+        if self.seed is not None:
+            generator.manual_seed(int(np.random.SeedSequence([self.seed, self.epoch]).generate_state(1)[0]))
+        else:
+            generator.seed()
+        # Inverse-CDF draw: torch.multinomial is limited to 2**24 categories.
+        cdf = self.probs.cumsum(0)
+        draws = torch.rand(self.num_samples, generator=generator, dtype=torch.float64) * cdf[-1]
+        self._order = torch.searchsorted(cdf, draws).clamp_(max=self.num_samples - 1)
+        return iter(self._order.split(self.batch_size))
+
+    def batch_rows(self, index):
+        """Dataset rows of the index-th batch of the current epoch."""
+        return self._order[index * self.batch_size:(index + 1) * self.batch_size]
+
+    def importance_weights(self, rows):
+        return (1.0 / (self.num_samples * self.probs[rows])).float()
+
+    def update(self, rows, losses):
+        self.loss_ema[rows] = self.momentum * self.loss_ema[rows] + (1 - self.momentum) * losses
+
+    def hard_share(self, top=0.1):
+        """Share of this epoch's draws that go to the `top` fraction of highest-loss rows."""
+        return self.probs.topk(max(1, int(top * self.num_samples))).values.sum().item()
+
+    def state_dict(self):
+        return {'loss_ema': self.loss_ema, 'probs': self.probs, 'probs_epoch': self.probs_epoch}
+
+    def load_state_dict(self, state):
+        self.loss_ema = state['loss_ema']
+        self.probs = state['probs']
+        self.probs_epoch = state['probs_epoch']
+
+class StreamingLayoutDataset(IterableDataset):
+    """Generates and tokenizes samples on the fly (train.py --stream).
+
+    Every DataLoader worker builds its own generate_data.BatchSampler seeded from
+    (seed, worker id, pass number), so each epoch sees fresh samples and no CSV is
+    written. Yields ready-made (inputs, labels) batches; use DataLoader(batch_size=None).
+    """
+    def __init__(self, sources, samples_per_epoch, batch_size, seed=0, num_workers=0, first_pass=0, rank=0, world_size=1):
+        self.sources = sources
+        # With several (--ddp-cpu) ranks each gets an equal share, so all run the same number of steps.
+        self.samples_per_epoch = samples_per_epoch // world_size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.num_workers = num_workers
+        self.rank = rank
+        self._passes = first_pass
+
+    def _share(self, worker_id, num_workers):
+        share = self.samples_per_epoch // num_workers
+        return share + (1 if worker_id < self.samples_per_epoch % num_workers else 0)
+
+    def __len__(self):
+        workers = max(self.num_workers, 1)
+        return sum(math.ceil(self._share(w, workers) / self.batch_size) for w in range(workers))
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        # Each worker keeps its own copy of the dataset (persistent_workers), so the
+        # pass counter advances once per epoch in every worker.
+        stream_id = self.rank * num_workers + worker_id
+        seed_seq = np.random.SeedSequence([self.seed, stream_id, self._passes])
+        self._passes += 1
+        sampler = generate_data.BatchSampler(**self.sources, seed=seed_seq)
+
+        remaining = self._share(worker_id, num_workers)
+        while remaining > 0:
+            n = min(self.batch_size, remaining)
+            texts, labels = sampler.sample(n)
+            inputs = torch.from_numpy(encode_texts(texts))
+            targets = torch.tensor([CLASS_TO_IDX[label] for label in labels], dtype=torch.long)
+            yield inputs, targets
+            remaining -= n
+
+def build_stream_datasets(args, num_workers, seed, first_pass=0, rank=0, world_size=1):
+    """Streaming train dataset plus a fixed, pre-tokenized generated validation set."""
+    sources = generate_data.prepare_sources(args)
+    train_dataset = StreamingLayoutDataset(
+        sources,
+        args.stream_samples,
+        args.batch_size,
+        seed=seed,
+        num_workers=num_workers,
+        first_pass=first_pass,
+        rank=rank,
+        world_size=world_size,
+    )
+    # Stream ids are small non-negative ints, so this stream never overlaps a training stream.
+    val_sampler = generate_data.BatchSampler(**sources, seed=np.random.SeedSequence([seed, 2**31]))
+    texts, labels = val_sampler.sample(args.stream_val_samples)
+    val_dataset = TensorLayoutDataset(
+        torch.from_numpy(encode_texts(texts)),
+        torch.tensor([CLASS_TO_IDX[label] for label in labels], dtype=torch.long),
+    )
+    return train_dataset, val_dataset
+
 # ============== MIXUP ==============
 
 def mixup_data(x, y, alpha=0.2):
@@ -140,9 +495,14 @@ class PositionalEncoding(nn.Module):
 # ============== TRACEABLE TRANSFORMER (CoreML-friendly) ==============
 
 class TraceableMultiheadSelfAttention(nn.Module):
-    """Multi-head self-attention implemented with basic ops (trace/CoreML-friendly)."""
+    """Multi-head self-attention implemented with basic ops (trace/CoreML-friendly).
 
-    def __init__(self, d_model: int, nhead: int, dropout: float = 0.0):
+    With fused=True (see set_fused_attention) the attention itself runs through
+    F.scaled_dot_product_attention instead: same parameters and state_dict, faster in
+    eager training / inference, but not what CoreML export should trace.
+    """
+
+    def __init__(self, d_model: int, nhead: int, dropout: float = 0.0, fused: bool = False):
         super().__init__()
         if d_model % nhead != 0:
             raise ValueError(f"d_model ({d_model}) must be divisible by nhead ({nhead})")
@@ -150,6 +510,7 @@ class TraceableMultiheadSelfAttention(nn.Module):
         self.d_model = d_model
         self.nhead = nhead
         self.head_dim = d_model // nhead
+        self.fused = fused
 
         # Match nn.MultiheadAttention parameter names for state_dict compatibility.
         self.in_proj_weight = nn.Parameter(torch.empty(3 * d_model, d_model))
@@ -175,12 +536,16 @@ class TraceableMultiheadSelfAttention(nn.Module):
         k = k.view(bsz, seq_len, self.nhead, self.head_dim).transpose(1, 2)
         v = v.view(bsz, seq_len, self.nhead, self.head_dim).transpose(1, 2)
 
-        scale = 1.0 / math.sqrt(self.head_dim)
-        attn = torch.matmul(q, k.transpose(-2, -1)) * scale
-        attn = torch.softmax(attn, dim=-1)
-        attn = self.attn_dropout(attn)
+        if self.fused:
+            dropout_p = self.attn_dropout.p if self.training else 0.0
+            out = torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        else:
+            scale = 1.0 / math.sqrt(self.head_dim)
+            attn = torch.matmul(q, k.transpose(-2, -1)) * scale
+            attn = torch.softmax(attn, dim=-1)
+            attn = self.attn_dropout(attn)
+            out = torch.matmul(attn, v)
 
-        out = torch.matmul(attn, v)
         out = out.transpose(1, 2).contiguous().view(bsz, seq_len, self.d_model)
         return self.out_proj(out)
 
@@ -236,6 +601,18 @@ class TraceableTransformerEncoder(nn.Module):
             output = layer(output)
         return output
 
+def set_fused_attention(model, enabled=True):
+    """Switch every TraceableMultiheadSelfAttention in `model` to (or off) the SDPA path.
+
+    Returns the number of modules switched: 0 unless the model was built traceable.
+    """
+    switched = 0
+    for module in model.modules():
+        if isinstance(module, TraceableMultiheadSelfAttention):
+            module.fused = enabled
+            switched += 1
+    return switched
+
 # ============== TRANSFORMER MODEL ==============
 
 class LayoutTransformer(nn.Module):
@@ -272,7 +649,8 @@ class LayoutTransformer(nn.Module):
         self.fc2 = nn.Linear(d_model // 2, len(CLASSES))
         self.gelu = nn.GELU()
         
-    def forward(self, x):
+    def features(self, x):
+        """Pooled backbone output [Batch, d_model]; head() maps it to logits."""
         # x: [Batch, SeqLen]
         x = self.embedding(x)  # [Batch, SeqLen, d_model]
         x = self.pos_encoder(x)
@@ -280,48 +658,63 @@ class LayoutTransformer(nn.Module):
         
         # Pool over sequence
         x = x.permute(0, 2, 1)  # [Batch, d_model, SeqLen]
-        x = self.pool(x).squeeze(2)  # [Batch, d_model]
-        
+        return self.pool(x).squeeze(2)  # [Batch, d_model]
+
+    def head(self, x):
         x = self.dropout(x)
         x = self.gelu(self.fc1(x))
         x = self.fc2(x)
         return x
 
+    def forward(self, x):
+        return self.head(self.features(x))
+
 # ============== CNN MODEL V2 ==============
 
 class LayoutClassifierV2(nn.Module):
     """Enhanced multi-scale CNN for maximum accuracy"""
-    def __init__(self, embedding_dim=128, hidden_dim=384):
+    # Layers whose output width `widths` can override (prune.py shrinks them).
+    WIDTH_LAYERS = ('conv2', 'conv3', 'conv4', 'conv5', 'conv2_a', 'conv2_b', 'conv3_deep', 'fc1', 'fc2')
+
+    def __init__(self, embedding_dim=128, hidden_dim=384, widths=None):
         super(LayoutClassifierV2, self).__init__()
+        w = {
+            'conv2': hidden_dim // 4, 'conv3': hidden_dim // 4, 'conv4': hidden_dim // 4, 'conv5': hidden_dim // 4,
+            'conv2_a': hidden_dim, 'conv2_b': hidden_dim, 'conv3_deep': hidden_dim,
+            'fc1': hidden_dim, 'fc2': hidden_dim // 2,
+        }
+        w.update(widths or {})
+        multi_scale = w['conv2'] + w['conv3'] + w['conv4'] + w['conv5']
         
         self.embedding = nn.Embedding(VOCAB_SIZE, embedding_dim, padding_idx=0)
         
         # Multi-scale: 2, 3, 4, 5 character patterns
-        self.conv2 = nn.Conv1d(embedding_dim, hidden_dim // 4, kernel_size=2, padding=1)
-        self.conv3 = nn.Conv1d(embedding_dim, hidden_dim // 4, kernel_size=3, padding=1)
-        self.conv4 = nn.Conv1d(embedding_dim, hidden_dim // 4, kernel_size=4, padding=2)
-        self.conv5 = nn.Conv1d(embedding_dim, hidden_dim // 4, kernel_size=5, padding=2)
+        self.conv2 = nn.Conv1d(embedding_dim, w['conv2'], kernel_size=2, padding=1)
+        self.conv3 = nn.Conv1d(embedding_dim, w['conv3'], kernel_size=3, padding=1)
+        self.conv4 = nn.Conv1d(embedding_dim, w['conv4'], kernel_size=4, padding=2)
+        self.conv5 = nn.Conv1d(embedding_dim, w['conv5'], kernel_size=5, padding=2)
         
-        self.bn1 = nn.BatchNorm1d(hidden_dim)
+        self.bn1 = nn.BatchNorm1d(multi_scale)
         
-        self.conv2_a = nn.Conv1d(hidden_dim, hidden_dim, kernel_size=3, padding=1)
-        self.conv2_b = nn.Conv1d(hidden_dim, hidden_dim, kernel_size=5, padding=2)
-        self.bn2 = nn.BatchNorm1d(hidden_dim * 2)
+        self.conv2_a = nn.Conv1d(multi_scale, w['conv2_a'], kernel_size=3, padding=1)
+        self.conv2_b = nn.Conv1d(multi_scale, w['conv2_b'], kernel_size=5, padding=2)
+        self.bn2 = nn.BatchNorm1d(w['conv2_a'] + w['conv2_b'])
         
-        self.conv3_deep = nn.Conv1d(hidden_dim * 2, hidden_dim, kernel_size=3, padding=1)
-        self.bn3 = nn.BatchNorm1d(hidden_dim)
+        self.conv3_deep = nn.Conv1d(w['conv2_a'] + w['conv2_b'], w['conv3_deep'], kernel_size=3, padding=1)
+        self.bn3 = nn.BatchNorm1d(w['conv3_deep'])
         
         self.global_max_pool = nn.AdaptiveMaxPool1d(1)
         self.global_avg_pool = nn.AdaptiveAvgPool1d(1)
         
         self.dropout = nn.Dropout(0.4)
-        self.fc1 = nn.Linear(hidden_dim * 2, hidden_dim)
-        self.fc2 = nn.Linear(hidden_dim, hidden_dim // 2)
-        self.fc3 = nn.Linear(hidden_dim // 2, len(CLASSES))
+        self.fc1 = nn.Linear(w['conv3_deep'] * 2, w['fc1'])
+        self.fc2 = nn.Linear(w['fc1'], w['fc2'])
+        self.fc3 = nn.Linear(w['fc2'], len(CLASSES))
         
         self.gelu = nn.GELU()
 
-    def forward(self, x):
+    def features(self, x):
+        """Pooled backbone output [batch, 2 * conv3_deep width] (global max + avg); head() maps it to logits."""
         x = self.embedding(x)
         x = x.permute(0, 2, 1)
         
@@ -351,8 +744,9 @@ class LayoutClassifierV2(nn.Module):
         
         x_max = self.global_max_pool(x).squeeze(2)
         x_avg = self.global_avg_pool(x).squeeze(2)
-        x = torch.cat([x_max, x_avg], dim=1)
-        
+        return torch.cat([x_max, x_avg], dim=1)
+
+    def head(self, x):
         x = self.dropout(x)
         x = self.gelu(self.fc1(x))
         x = self.dropout(x)
@@ -361,6 +755,17 @@ class LayoutClassifierV2(nn.Module):
         
         return x
 
+    def forward(self, x):
+        return self.head(self.features(x))
+
+    @staticmethod
+    def config_from_state_dict(state):
+        """Constructor kwargs matching a (possibly pruned) state_dict."""
+        return {
+            'embedding_dim': state['embedding.weight'].shape[1],
+            'widths': {name: state[f'{name}.weight'].shape[0] for name in LayoutClassifierV2.WIDTH_LAYERS},
+        }
+
 # ============== BASIC CNN (backward compat) ==============
 
 class LayoutClassifier(nn.Module):
@@ -375,7 +780,7 @@ class LayoutClassifier(nn.Module):
         self.fc = nn.Linear(128, len(CLASSES))
         self.dropout = nn.Dropout(0.2)
 
-    def forward(self, x):
+    def features(self, x):
         x = self.embedding(x)
         x = x.permute(0, 2, 1)
         x = self.conv1(x)
@@ -384,11 +789,16 @@ class LayoutClassifier(nn.Module):
         x = self.conv2(x)
         x = self.relu(x)
         x = self.global_pool(x)
-        x = x.squeeze(2)
+        return x.squeeze(2)
+
+    def head(self, x):
         x = self.dropout(x)
         x = self.fc(x)
         return x
 
+    def forward(self, x):
+        return self.head(self.features(x))
+
 # ============== ENSEMBLE ==============
 
 class EnsembleModel(nn.Module):
@@ -401,9 +811,17 @@ class EnsembleModel(nn.Module):
         self.weight_transformer = nn.Parameter(torch.tensor(0.4))
         
     def forward(self, x):
-        out_cnn = self.cnn(x)
-        out_transformer = self.transformer(x)
-        
+        return self._combine(self.cnn(x), self.transformer(x))
+
+    def features(self, x):
+        """CNN and Transformer pooled features side by side (see head())."""
+        return torch.cat([self.cnn.features(x), self.transformer.features(x)], dim=1)
+
+    def head(self, features):
+        cnn_dim = self.cnn.fc1.in_features
+        return self._combine(self.cnn.head(features[:, :cnn_dim]), self.transformer.head(features[:, cnn_dim:]))
+
+    def _combine(self, out_cnn, out_transformer):
         # Learnable weighted average
         w_cnn = torch.sigmoid(self.weight_cnn)
         w_transformer = torch.sigmoid(self.weight_transformer)
@@ -411,163 +829,950 @@ class EnsembleModel(nn.Module):
         
         return (w_cnn * out_cnn + w_transformer * out_transformer) / total
 
-# ============== TRAINING ==============
+# ============== DISTILLATION ==============
 
-def train(args):
-    device = torch.device("mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-    
-    num_workers = min(os.cpu_count() or 4, 8)
-    pin_memory = device.type != "mps"
-    persistent_workers = num_workers > 0
+def load_state_dict_file(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=True)
+    except TypeError:
+        return torch.load(path, map_location="cpu")
+
+def compute_teacher_logits(teacher, dataset, device, batch_size=4096):
+    """float16 [len(dataset), len(CLASSES)] logits of `teacher` over the whole dataset."""
+    teacher.eval()
+    logits = np.empty((len(dataset), len(CLASSES)), dtype=np.float16)
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            inputs, _ = dataset[torch.arange(start, min(start + batch_size, len(dataset)))]
+            logits[start:start + len(inputs)] = teacher(inputs.to(device)).float().cpu().numpy()
+    return logits
+
+def load_teacher_logits(teacher, dataset, data_path, teacher_path, cache_dir, device):
+    """Teacher logits for every row of `dataset`, cached as .npy keyed by data and teacher hashes."""
+    if not cache_dir:
+        return torch.from_numpy(compute_teacher_logits(teacher, dataset, device))
+    key = f"{generate_data.file_digest(data_path)}-{generate_data.file_digest(teacher_path)[:16]}"
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(data_path)}.{key}.teacher.npy")
+    if os.path.exists(cache_path):
+        print(f"Using cached teacher logits {cache_path}")
+    else:
+        start = time.perf_counter()
+        logits = compute_teacher_logits(teacher, dataset, device)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, logits)
+        os.replace(tmp_path, cache_path)
+        print(f"Cached teacher logits to {cache_path} ({time.perf_counter() - start:.1f}s)")
+    return torch.from_numpy(np.load(cache_path, mmap_mode='c'))
+
+def distillation_loss(student_logits, teacher_logits, labels, criterion, temperature, alpha):
+    """alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * hard-label loss.
+
+    Per-sample when criterion has reduction='none' (--hard-examples), else the batch mean.
+    """
+    soft = nn.functional.kl_div(
+        nn.functional.log_softmax(student_logits.float() / temperature, dim=1),
+        nn.functional.softmax(teacher_logits.float() / temperature, dim=1),
+        reduction='none',
+    ).sum(1) * temperature ** 2
+    if criterion.reduction != 'none':
+        soft = soft.mean()
+    return alpha * soft + (1 - alpha) * criterion(student_logits, labels)
+
+def batch1_latency_ms(model, runs=200):
+    """Median single-string forward latency on CPU."""
+    model = model.to("cpu").eval()
+    inputs = torch.randint(1, VOCAB_SIZE, (1, INPUT_LENGTH))
+    times = []
+    with torch.inference_mode():
+        for _ in range(10):
+            model(inputs)
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(inputs)
+            times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+def evaluate_accuracy(model, dataset, device, batch_size=4096):
+    model.eval()
+    correct = 0
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            inputs, labels = dataset[torch.arange(start, min(start + batch_size, len(dataset)))][:2]
+            correct += (model(inputs.to(device)).argmax(1).cpu() == labels).sum().item()
+    return 100 * correct / len(dataset)
+
+def report_distillation(student, teacher, val_dataset, teacher_logits, device):
+    """Print accuracy / size / batch-1 latency of the distilled student next to its teacher."""
+    teacher_acc = 100 * (teacher_logits[val_dataset.rows].float().argmax(1) == val_dataset[torch.arange(len(val_dataset))][1]).float().mean().item()
+    student_acc = evaluate_accuracy(student, val_dataset, device)
+    rows = []
+    for name, model, acc in (("teacher", teacher, teacher_acc), ("student", student, student_acc)):
+        params = sum(p.numel() for p in model.parameters())
+        rows.append((name, type(model).__name__, acc, params, batch1_latency_ms(model)))
+    print(f"\nDistillation report (val: {len(val_dataset)} samples, CPU batch-1 latency)")
+    for name, arch, acc, params, latency in rows:
+        print(f"  {name:8s} {arch:20s} acc {acc:6.2f}%  params {params:>10,}  latency {latency:.3f} ms")
+    print(f"  student is {rows[0][4] / rows[1][4]:.1f}x faster, {student_acc - teacher_acc:+.2f} pts accuracy")
+
+# ============== QUANTIZATION-AWARE TRAINING ==============
+
+QAT_LAYERS = (nn.Conv1d, nn.Linear)
+
+def weight_fake_quant():
+    """int8 per-output-channel symmetric, scale = max|w| / 127 of the current weights.
+
+    averaging_constant=1.0 makes the observer track the latest weights exactly, like the
+    per-channel symmetric scheme of export.py --quantize int8 (coremltools linear_symmetric).
+    """
+    return FakeQuantize(
+        observer=MovingAveragePerChannelMinMaxObserver,
+        averaging_constant=1.0,
+        quant_min=-127,
+        quant_max=127,
+        dtype=torch.qint8,
+        qscheme=torch.per_channel_symmetric,
+        ch_axis=0,
+    )
+
+def activation_fake_quant():
+    return FakeQuantize(
+        observer=MovingAverageMinMaxObserver,
+        quant_min=0,
+        quant_max=255,
+        dtype=torch.quint8,
+        qscheme=torch.per_tensor_affine,
+    )
+
+def _fake_quant_input(module, inputs):
+    fake_quant = getattr(module, 'input_fake_quant', None)
+    if fake_quant is not None:
+        return (fake_quant(inputs[0]),) + tuple(inputs[1:])
+
+def prepare_qat(model):
+    """Insert fake-quant in place: int8 weights for every Conv1d/Linear and the attention
+    in_proj, uint8 inputs to every Conv1d/Linear. Transformers must be built traceable, so
+    attention runs through these modules instead of fused nn.MultiheadAttention kernels.
+    """
+    for module in list(model.modules()):
+        if isinstance(module, QAT_LAYERS):
+            parametrize.register_parametrization(module, "weight", weight_fake_quant())
+            module.input_fake_quant = activation_fake_quant()
+            module.register_forward_pre_hook(_fake_quant_input)
+        elif isinstance(module, TraceableMultiheadSelfAttention):
+            parametrize.register_parametrization(module, "in_proj_weight", weight_fake_quant())
+    return model
+
+def qat_float_state_dict(model):
+    """Plain float state_dict of a prepare_qat model: the original keys, with weights snapped
+    to their int8 grid and all fake-quant state dropped (loads into an unprepared model).
+    """
+    state = {
+        key: value for key, value in model.state_dict().items()
+        if '.parametrizations.' not in f".{key}" and 'input_fake_quant.' not in key
+    }
+    with torch.no_grad():
+        for name, module in model.named_modules():
+            if parametrize.is_parametrized(module):
+                for param_name in module.parametrizations.keys():
+                    state[f"{name}.{param_name}" if name else param_name] = getattr(module, param_name).detach().clone()
+    return {key: value.cpu() for key, value in state.items()}
+
+def int8_weight_bytes(model):
+    """Size of the weights once Conv1d/Linear/in_proj weights are int8 with fp32 per-channel scales."""
+    quantized = {id(m.weight) for m in model.modules() if isinstance(m, QAT_LAYERS)}
+    quantized |= {id(m.in_proj_weight) for m in model.modules() if isinstance(m, TraceableMultiheadSelfAttention)}
+    size = 0
+    for p in model.parameters():
+        size += p.numel() + 4 * p.shape[0] if id(p) in quantized else 4 * p.numel()
+    return size
+
+def report_qat(args, qat_model, val_dataset):
+    """Print float vs QAT accuracy, weight size and CPU batch-1 latency."""
+    float_model, _ = build_model(args)
+    float_model.load_state_dict(load_state_dict_file(args.model_in))
+    int8_model, _ = build_model(args)
+    int8_model.load_state_dict(load_state_dict_file(args.model_out))
+    float_acc = evaluate_accuracy(float_model, val_dataset, "cpu")
+    fake_quant_acc = evaluate_accuracy(qat_model.cpu(), val_dataset, "cpu")
+    int8_acc = evaluate_accuracy(int8_model, val_dataset, "cpu")
+    float_bytes = 4 * sum(p.numel() for p in float_model.parameters())
+    int8_bytes = int8_weight_bytes(int8_model)
+    # CoreML is not available here; dynamic int8 Linear kernels stand in for the CPU latency.
+    dynamic_model = torch.ao.quantization.quantize_dynamic(int8_model, {nn.Linear}, dtype=torch.qint8)
+    float_latency = batch1_latency_ms(float_model)
+    int8_latency = batch1_latency_ms(dynamic_model)
+    print(f"\nQAT report (val: {len(val_dataset)} samples)")
+    print(f"  accuracy: float {float_acc:.2f}% -> int8 weights {int8_acc:.2f}% ({int8_acc - float_acc:+.2f} pts), "
+          f"int8 weights+activations (fake-quant) {fake_quant_acc:.2f}%")
+    print(f"  weights: {float_bytes / 1e6:.2f} MB fp32 -> {int8_bytes / 1e6:.2f} MB int8 ({float_bytes / int8_bytes:.1f}x smaller)")
+    print(f"  CPU batch-1 latency: {float_latency:.3f} ms fp32 -> {int8_latency:.3f} ms dynamic int8 Linear ({float_latency / int8_latency:.2f}x)")
+    print(f"  Export with: python export.py --model_in {args.model_out} --quantize int8 (plus the same model flag)")
+
+# ============== HEAD-ONLY FINE-TUNING ==============
+
+def head_parameters(model):
+    """Parameters used by model.head(): the fc layers, plus the ensemble mixing weights."""
+    params = []
+    for name, param in model.named_parameters():
+        parts = name.split('.')
+        if any(part.startswith('fc') for part in parts[:-1]) or parts[0].startswith('weight_'):
+            params.append(param)
+    return params
+
+def compute_features(model, dataset, device, out, batch_size=4096):
+    """Fill out[len(dataset), feature_dim] with model.features() (eval mode)."""
+    model.eval()
+    with torch.inference_mode():
+        for start in range(0, len(dataset), batch_size):
+            inputs, _ = dataset[torch.arange(start, min(start + batch_size, len(dataset)))][:2]
+            out[start:start + len(inputs)] = model.features(inputs.to(device)).float().cpu().numpy()
+    return out
+
+def feature_dim(model):
+    """Width of model.features() output, read from the head's first Linear (no forward pass)."""
+    if isinstance(model, EnsembleModel):
+        return feature_dim(model.cnn) + feature_dim(model.transformer)
+    return (model.fc1 if hasattr(model, 'fc1') else model.fc).in_features
+
+def load_backbone_features(model, dataset, data_path, model_path, cache_dir, device):
+    """float16 pooled backbone features for every row of `dataset`, cached as .npy keyed by data and checkpoint hashes."""
+    shape = (len(dataset), feature_dim(model))
+    if not cache_dir:
+        return torch.from_numpy(compute_features(model, dataset, device, np.empty(shape, dtype=np.float16)))
+    key = f"{generate_data.file_digest(data_path)}-{generate_data.file_digest(model_path)[:16]}"
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(data_path)}.{key}.{type(model).__name__}.features.npy")
+    if os.path.exists(cache_path):
+        print(f"Using cached backbone features {cache_path}")
+    else:
+        start = time.perf_counter()
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        # Written through a memmap, so ULTRA-sized feature tables never sit in RAM.
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=shape)
+        compute_features(model, dataset, device, out)
+        out.flush()
+        del out
+        os.replace(tmp_path, cache_path)
+        print(f"Cached backbone features to {cache_path} ({shape[0]} x {shape[1]}, {time.perf_counter() - start:.1f}s)")
+    return torch.from_numpy(np.load(cache_path, mmap_mode='c'))
+
+def train_head_only(args, model, full_dataset, train_indices, val_indices, device, seed):
+    """--head-only: freeze the backbone, cache its pooled features once and train only the fc head.
+
+    The backbone always runs in eval mode, so head(features) gives exactly the logits of
+    the full model and model_out is a regular checkpoint for export.py.
+    """
+    features = load_backbone_features(model, full_dataset, args.data, args.model_in, args.token_cache_dir, device)
+    labels = full_dataset[torch.arange(len(full_dataset))][1]
+    train_rows = torch.as_tensor(train_indices, dtype=torch.long)
+    val_rows = torch.as_tensor(val_indices, dtype=torch.long)
     
-    # Dataset with augmentation for training
-    full_dataset = LayoutDataset(args.data, augment=False)  # Load without aug first for split
+    for param in model.parameters():
+        param.requires_grad_(False)
+    params = head_parameters(model)
+    for param in params:
+        param.requires_grad_(True)
+    print(f"Head-only fine-tuning: {sum(p.numel() for p in params):,} of {sum(p.numel() for p in model.parameters()):,} parameters, "
+          f"{features.shape[1]}-dim cached features")
+    if args.augment or args.mixup:
+        print("Note: --augment / --mixup do not apply to cached features and are ignored")
     
-    train_size = int(0.9 * len(full_dataset))
-    val_size = len(full_dataset) - train_size
-    train_indices, val_indices = torch.utils.data.random_split(
-        range(len(full_dataset)), [train_size, val_size]
-    )
+    criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+    optimizer = optim.AdamW(params, lr=args.lr, weight_decay=0.01)
+    generator = torch.Generator().manual_seed(seed)
+    best_val_acc = 0.0
+    patience_counter = 0
     
-    # Create augmented training dataset
-    train_dataset = LayoutDataset(args.data, augment=args.augment)
-    train_dataset.data = full_dataset.data.iloc[train_indices.indices].reset_index(drop=True)
+    def evaluate(rows):
+        model.eval()
+        correct = 0
+        with torch.no_grad():
+            for batch in rows.split(args.batch_size * 8):
+                outputs = model.head(features[batch].float().to(device))
+                correct += (outputs.argmax(1).cpu() == labels[batch]).sum().item()
+        return 100 * correct / len(rows)
     
-    val_dataset = LayoutDataset(args.data, augment=False)
-    val_dataset.data = full_dataset.data.iloc[val_indices.indices].reset_index(drop=True)
+    print(f"Val before fine-tuning: {evaluate(val_rows):.2f}%")
+    for epoch in range(args.epochs):
+        start = time.perf_counter()
+        model.train()
+        total_loss = 0.0
+        order = train_rows[torch.randperm(len(train_rows), generator=generator)]
+        batches = order.split(args.batch_size)
+        for batch in batches:
+            inputs, targets = features[batch].float().to(device), labels[batch].to(device)
+            loss = criterion(model.head(inputs), targets)
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(params, max_norm=1.0)
+            optimizer.step()
+            total_loss += loss.item()
+        val_acc = evaluate(val_rows)
+        print(f"Epoch {epoch+1}/{args.epochs} | Loss: {total_loss/len(batches):.4f} | Val: {val_acc:.2f}% | {time.perf_counter() - start:.1f}s")
+        if val_acc > best_val_acc:
+            best_val_acc = val_acc
+            patience_counter = 0
+            model.to("cpu")
+            torch.save(model.state_dict(), args.model_out)
+            model.to(device)
+            print(f"  → Best model saved! (Val: {val_acc:.2f}%)")
+        else:
+            patience_counter += 1
+            if patience_counter >= args.patience and epoch >= 3:
+                print(f"Early stopping at epoch {epoch+1}")
+                break
     
-    train_loader = DataLoader(
-        train_dataset, 
-        batch_size=args.batch_size, 
-        shuffle=True,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-        persistent_workers=persistent_workers
+    print(f"\nBest validation accuracy: {best_val_acc:.2f}%")
+    print(f"Model saved to {args.model_out}")
+    return best_val_acc
+
+# ============== TRAINING ==============
+
+def fast_autocast_dtype(device):
+    """Mixed-precision dtype for --fast: bfloat16 on CPU, float16 (with GradScaler) on CUDA."""
+    return {"cpu": torch.bfloat16, "cuda": torch.float16}.get(device.type)
+
+def measure_samples_per_sec(model, inputs, labels, criterion, autocast_dtype=None, steps=10, warmup=2, windows=1):
+    """Forward+backward throughput on one batch; gradients are discarded.
+
+    With windows > 1, the median rate of that many timed windows of `steps` steps.
+    """
+    device_type = inputs.device.type
+    model.train()
+
+    def run(n):
+        for _ in range(n):
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype or torch.float32, enabled=autocast_dtype is not None):
+                loss = criterion(model(inputs), labels)
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+        if device_type == "cuda":
+            torch.cuda.synchronize()
+
+    run(warmup)
+    rates = []
+    for _ in range(windows):
+        start = time.perf_counter()
+        run(steps)
+        rates.append(steps * len(inputs) / (time.perf_counter() - start))
+    return float(np.median(rates))
+
+def measure_ddp_samples_per_sec(model, inputs, labels):
+    """measure_samples_per_sec with the longer warm-up and median of windows the DDP scaling report needs."""
+    return measure_samples_per_sec(model, inputs, labels, nn.CrossEntropyLoss(), steps=5, warmup=5, windows=5)
+
+def setup_fast(model, device, inputs, labels, criterion):
+    """--fast: torch.compile + autocast, falling back to eager when compile fails.
+
+    Returns (forward_model, autocast_dtype). Checkpoints should still be saved from
+    `model`: the compiled wrapper shares its parameters but prefixes state_dict keys.
+    """
+    autocast_dtype = fast_autocast_dtype(device)
+    # The benchmark steps update BatchNorm running stats; restore them afterwards.
+    state = copy.deepcopy(model.state_dict())
+    eager_rate = measure_samples_per_sec(model, inputs, labels, criterion)
+    forward_model = model
+    if hasattr(torch, "compile") and device.type != "mps":
+        try:
+            compiled = torch.compile(model)
+            measure_samples_per_sec(compiled, inputs, labels, criterion, autocast_dtype, steps=1)
+            forward_model = compiled
+        except Exception as e:
+            print(f"torch.compile failed, training eager: {type(e).__name__}: {e}")
+    fast_rate = measure_samples_per_sec(forward_model, inputs, labels, criterion, autocast_dtype)
+    model.load_state_dict(state)
+    mode = "compiled" if forward_model is not model else "eager"
+    precision = str(autocast_dtype).replace("torch.", "") if autocast_dtype else "fp32"
+    print(f"Fast mode ({mode}, {precision}): {fast_rate:,.0f} samples/s vs eager fp32 {eager_rate:,.0f} samples/s ({fast_rate / eager_rate:.2f}x)")
+    return forward_model, autocast_dtype
+
+def capture_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(path, **state):
+    """Write a full training-state checkpoint (plus RNG states) atomically: tmp file + os.replace."""
+    state['rng'] = capture_rng_state()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location="cpu")
+
+def train_val_split(n, seed):
+    """90/10 (train_indices, val_indices) split of range(n), fixed by seed."""
+    train_size = int(0.9 * n)
+    train_indices, val_indices = torch.utils.data.random_split(
+        range(n), [train_size, n - train_size], generator=torch.Generator().manual_seed(seed)
     )
-    
-    val_loader = DataLoader(
+    return train_indices.indices, val_indices.indices
+
+def stratified_sample(labels, n, seed):
+    """Sorted indices of a fixed n-row subsample keeping each class's share of `labels`."""
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    quotas = counts * n / len(labels)
+    take = np.floor(quotas).astype(int)
+    # Largest-remainder rounding so the per-class counts sum to n.
+    take[np.argsort(take - quotas)[:n - take.sum()]] += 1
+    picked = [rng.choice(np.flatnonzero(labels == c), k, replace=False) for c, k in zip(classes, take)]
+    return np.sort(np.concatenate(picked))
+
+def wilson_interval(correct, total, z=1.96):
+    """Wilson score interval (95% by default) of an accuracy, in percent."""
+    p = correct / total
+    denom = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return 100 * (center - half), 100 * (center + half)
+
+def make_val_loader(val_dataset, batch_size, pin_memory, num_replicas=1, rank=0):
+    return DataLoader(
         val_dataset,
-        batch_size=args.batch_size * 2,
-        shuffle=False,
-        num_workers=num_workers,
+        sampler=BatchSliceSampler(len(val_dataset), batch_size, shuffle=False, num_replicas=num_replicas, rank=rank, pad=False),
+        batch_size=None,
+        pin_memory=pin_memory,
+        generator=torch.Generator()
+    )
+
+def make_loaders(train_dataset, val_dataset, batch_size, pin_memory, seed=None, num_replicas=1, rank=0, train_sampler=None):
+    """Loaders over TensorLayoutDataset: the sampler yields index slices, the dataset gathers batches.
+
+    Each loader gets its own generator so creating an iterator does not draw from the
+    global torch RNG, which --resume restores mid-epoch. train_sampler replaces the
+    shuffled BatchSliceSampler (e.g. with a HardExampleSampler).
+    """
+    if train_sampler is None:
+        train_sampler = BatchSliceSampler(len(train_dataset), batch_size, shuffle=True, seed=seed, num_replicas=num_replicas, rank=rank)
+    train_loader = DataLoader(
+        train_dataset,
+        sampler=train_sampler,
+        batch_size=None,
         pin_memory=pin_memory,
-        persistent_workers=persistent_workers
+        generator=torch.Generator()
     )
     
-    # Model selection
+    val_loader = make_val_loader(val_dataset, batch_size * 2, pin_memory, num_replicas, rank)
+    return train_loader, val_loader
+
+def all_reduce_sum(*values):
+    """Sum Python numbers across --ddp-cpu ranks."""
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals)
+    return [v.item() if isinstance(x, float) else int(v.item()) for v, x in zip(totals, values)]
+
+def synthetic_batch(batch_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    inputs = torch.randint(1, VOCAB_SIZE, (batch_size, INPUT_LENGTH), generator=generator)
+    labels = torch.randint(0, len(CLASSES), (batch_size,), generator=generator)
+    return inputs, labels
+
+def report_ddp_scaling(ddp_model, args, world_size, baseline):
+    """Time DDP steps on every rank and print throughput against the 1-process baseline."""
+    inputs, labels = synthetic_batch(args.batch_size)
+    state = copy.deepcopy(ddp_model.state_dict())
+    rate = measure_ddp_samples_per_sec(ddp_model, inputs, labels)
+    ddp_model.load_state_dict(state)
+    (total,) = all_reduce_sum(rate)
+    if baseline:
+        speedup = total / baseline
+        print(f"DDP scaling: 1 process {baseline:,.0f} samples/s -> {world_size} processes {total:,.0f} samples/s "
+              f"({speedup:.2f}x, {100 * speedup / world_size:.0f}% efficiency; "
+              f"{world_size} x {torch.get_num_threads()} threads on {os.cpu_count()} CPUs)")
+
+def build_model(args):
+    """Model selected by --student (with --distill-from) or --ensemble / --transformer / --model_v2.
+
+    Returns (model, description).
+    """
+    if args.distill_from:
+        if args.student == 'v2':
+            return LayoutClassifierV2(), "LayoutClassifierV2 (distilled student)"
+        return LayoutClassifier(), "LayoutClassifier (distilled student)"
+    # --qat needs the traceable attention (same state_dict keys) so it can be fake-quantized.
     if args.ensemble:
-        model = EnsembleModel().to(device)
-        print("Using Ensemble (CNN + Transformer)")
-    elif args.transformer:
-        model = LayoutTransformer().to(device)
-        print("Using LayoutTransformer")
-    elif args.model_v2:
-        model = LayoutClassifierV2().to(device)
-        print("Using LayoutClassifierV2 (enhanced CNN)")
+        return EnsembleModel(traceable_transformer=args.qat), "Ensemble (CNN + Transformer)"
+    if args.transformer:
+        model = LayoutTransformer(d_model=args.d_model, nhead=args.nhead, num_layers=args.num_layers, traceable=args.qat)
+        return model, "LayoutTransformer"
+    if args.model_v2:
+        # Channel widths follow --model_in, so pruned checkpoints (prune.py) fine-tune as-is.
+        if args.model_in:
+            config = LayoutClassifierV2.config_from_state_dict(load_state_dict_file(args.model_in))
+            return LayoutClassifierV2(**config), "LayoutClassifierV2 (enhanced CNN)"
+        return LayoutClassifierV2(embedding_dim=args.embedding_dim, hidden_dim=args.hidden_dim), "LayoutClassifierV2 (enhanced CNN)"
+    return LayoutClassifier(), "LayoutClassifier (basic)"
+
+def train(args, rank=0, world_size=1, ddp_baseline=None):
+    """Train per args and return the best validation accuracy.
+
+    With world_size > 1 this is one --ddp-cpu rank (process group already set up).
+    """
+    distributed = world_size > 1
+    if distributed:
+        device = torch.device("cpu")
     else:
-        model = LayoutClassifier().to(device)
-        print("Using LayoutClassifier (basic)")
+        device = torch.device("mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using device: {device}{f' x {world_size} processes' if distributed else ''}")
+    
+    num_workers = min(max((os.cpu_count() or 4) // world_size, 1), 8)
+    pin_memory = device.type != "mps"
+    persistent_workers = num_workers > 0
+    
+    # Full training state (model, optimizer, scheduler, counters, RNG) for --resume.
+    checkpoint_path = args.checkpoint or f"{args.model_out}.ckpt"
+    resume_state = None
+    if args.resume:
+        if os.path.exists(checkpoint_path):
+            resume_state = load_checkpoint(checkpoint_path)
+            print(f"Resuming from {checkpoint_path} (epoch {resume_state['epoch'] + 1}, batch {resume_state['step']})")
+        else:
+            print(f"No checkpoint at {checkpoint_path}, starting from scratch")
+    if resume_state is not None:
+        seed = resume_state['seed']
+    else:
+        seed = args.seed if args.seed is not None else random.randrange(2**31)
+    # Global RNGs drive init, augmentation and mixup; a resume restores their exact state later.
+    # Ranks get different streams (DDP broadcasts rank 0's initial weights).
+    random.seed(seed + rank)
+    np.random.seed(seed + rank)
+    torch.manual_seed(seed + rank)
+    start_epoch = resume_state['epoch'] if resume_state is not None else 0
+    
+    if args.qat:
+        # QAT always fine-tunes a trained float checkpoint.
+        if not args.model_in:
+            raise ValueError("--model_in is required when using --qat")
+        args.finetune = True
+    if args.distill_from and args.stream:
+        raise ValueError("--distill-from needs --data: teacher logits are cached per dataset")
+    if args.head_only:
+        if not args.model_in:
+            raise ValueError("--model_in is required when using --head-only")
+        if args.stream or distributed or args.qat or args.distill_from or args.hard_examples:
+            raise ValueError("--head-only trains on cached features of a fixed --data set: no --stream / --ddp-cpu / --qat / --distill-from / --hard-examples")
+        args.finetune = True
+    if args.hard_examples and (args.stream or distributed):
+        raise ValueError("--hard-examples needs a fixed --data set in a single process (no --stream / --ddp-cpu)")
+    hard_sampler = None
+    
+    if args.stream:
+        # On-the-fly generation: no CSV, fresh samples every epoch.
+        train_dataset, val_dataset = build_stream_datasets(
+            args, num_workers, seed, first_pass=start_epoch, rank=rank, world_size=world_size
+        )
+        train_count = args.stream_samples
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+            generator=torch.Generator()
+        )
+        val_loader = make_val_loader(val_dataset, args.batch_size * 2, pin_memory, world_size, rank)
+    else:
+        # Tokenize once into memory; batches are sliced out of the id tensor.
+        # Under DDP rank 0 goes first, so only it writes the token cache.
+        if distributed and rank != 0:
+            dist.barrier()
+        if args.data.endswith(TOKENIZED_SUFFIX):
+            full_dataset = TensorLayoutDataset.from_tokenized(args.data)
+        else:
+            full_dataset = TensorLayoutDataset.from_csv(args.data, cache_dir=args.token_cache_dir)
+        teacher_logits = None
+        if args.distill_from:
+            teacher = EnsembleModel()
+            teacher.load_state_dict(load_state_dict_file(args.distill_from))
+            print(f"Distilling from {args.distill_from} (T={args.distill_temperature}, alpha={args.distill_alpha})")
+            teacher_logits = load_teacher_logits(
+                teacher.to(device), full_dataset, args.data, args.distill_from, args.token_cache_dir, device
+            )
+        if distributed and rank == 0:
+            dist.barrier()
+    
+        train_indices, val_indices = train_val_split(len(full_dataset), seed)
+        train_dataset = full_dataset.subset(train_indices, soft_targets=teacher_logits)
+        val_dataset = full_dataset.subset(val_indices)
+        if args.hard_examples:
+            hard_sampler = HardExampleSampler(len(train_dataset), args.batch_size, seed=seed, uniform=args.hard_uniform)
+    
+        train_loader, val_loader = make_loaders(
+            train_dataset, val_dataset, args.batch_size, pin_memory, seed=seed, num_replicas=world_size, rank=rank,
+            train_sampler=hard_sampler
+        )
+        train_count = len(train_dataset)
+    
+    # --val-sample: a fixed stratified subsample of the validation split, scored every validation.
+    val_sample_loader = None
+    if args.val_sample and args.val_sample < len(val_dataset):
+        val_labels = val_dataset[torch.arange(len(val_dataset))][1].numpy()
+        val_sample = val_dataset.subset(stratified_sample(val_labels, args.val_sample, seed))
+        val_sample_loader = make_val_loader(val_sample, args.batch_size * 2, pin_memory, world_size, rank)
+    if distributed:
+        # Validation shards are exact (pad=False): every rank needs at least one row.
+        # All ranks see the same sizes, so they all raise here rather than one hanging later.
+        smallest = min(len(val_dataset), args.val_sample if val_sample_loader is not None else len(val_dataset))
+        if smallest < world_size:
+            raise ValueError(f"--ddp-cpu {world_size} needs at least {world_size} validation rows (got {smallest})")
+    
+    # Model selection
+    model, model_name = build_model(args)
+    model = model.to(device)
+    print(f"Using {model_name}")
 
     # Fine-tune from an existing checkpoint
     if args.finetune:
         if not args.model_in:
             raise ValueError("--model_in is required when using --finetune")
         print(f"Fine-tuning from: {args.model_in}")
-        try:
-            state = torch.load(args.model_in, map_location="cpu", weights_only=True)
-        except TypeError:
-            state = torch.load(args.model_in, map_location="cpu")
-        model.load_state_dict(state)
+        model.load_state_dict(load_state_dict_file(args.model_in))
+    
+    if args.head_only:
+        return train_head_only(args, model, full_dataset, train_indices, val_indices, device, seed)
+    
+    if args.qat:
+        model = prepare_qat(model).to(device)
+        print("Quantization-aware training: int8 fake-quant weights, uint8 fake-quant activations")
+    if args.fused_attention and not set_fused_attention(model):
+        raise ValueError("--fused-attention only applies to the traceable attention of --qat --transformer / --ensemble runs")
     
     # Count parameters
     total_params = sum(p.numel() for p in model.parameters())
     print(f"Total parameters: {total_params:,}")
     
     criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
+    # --hard-examples importance-weights each sample's loss, so the training loss stays unreduced.
+    train_criterion = nn.CrossEntropyLoss(label_smoothing=0.1, reduction='none') if args.hard_examples else criterion
     optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=0.01)
     scheduler = None if args.finetune else optim.lr_scheduler.CosineAnnealingWarmRestarts(optimizer, T_0=10, T_mult=2)
     
-    print(f"Training on {len(train_dataset)} samples, validating on {len(val_dataset)}")
+    print(f"Training on {train_count} samples{' per epoch (streamed)' if args.stream else ''}, validating on {len(val_dataset)}")
     print(f"Batch: {args.batch_size}, Epochs: {args.epochs}, LR: {args.lr}")
     print(f"Augmentation: {args.augment}, Mixup: {args.mixup}")
+    if args.val_every_steps:
+        print(f"Validating every {args.val_every_steps} steps (patience counts validations)")
+    if val_sample_loader is not None:
+        print(f"Validation sample: {args.val_sample} stratified rows; the full {len(val_dataset)} only for suspected new bests")
+    
+    # DDP / --fast wrap the model for training; `model` stays the plain module for saving.
+    forward_model, autocast_dtype = model, None
+    if distributed:
+        forward_model = DistributedDataParallel(model)
+        report_ddp_scaling(forward_model, args, world_size, ddp_baseline)
+    if args.fast:
+        sample_inputs, sample_labels = next(iter(train_loader))
+        forward_model, autocast_dtype = setup_fast(
+            forward_model, device, sample_inputs.to(device), sample_labels.to(device), criterion
+        )
+    use_autocast = autocast_dtype is not None
+    amp_dtype = autocast_dtype or torch.float32
+    try:
+        scaler = torch.amp.GradScaler("cuda", enabled=autocast_dtype == torch.float16)
+    except AttributeError:  # torch < 2.3
+        scaler = torch.cuda.amp.GradScaler(enabled=autocast_dtype == torch.float16)
+    
+    # Opt-in per-step phase timing (--step-log) and torch.profiler window (--profile-steps, rank 0).
+    step_log = f"{args.step_log}.rank{rank}" if args.step_log and distributed else args.step_log
+    timer = StepTimer(
+        step_log, device, rank,
+        profile_steps=args.profile_steps if rank == 0 else 0,
+        profile_start=args.profile_start,
+        trace_path=f"{args.model_out}.trace.json",
+    )
     
     best_val_acc = 0.0
+    best_sampled_acc = 0.0
     patience_counter = 0
+    global_step = 0
+    samples_seen = 0
+    target_reached = None
+    start_step = 0
+    best_qat_state = None
+    epoch_stats = (0, 0, 0)
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        if scheduler is not None and resume_state['scheduler'] is not None:
+            scheduler.load_state_dict(resume_state['scheduler'])
+        scaler.load_state_dict(resume_state['scaler'])
+        best_val_acc = resume_state['best_val_acc']
+        best_sampled_acc = resume_state.get('best_sampled_acc', 0.0)
+        patience_counter = resume_state['patience_counter']
+        global_step = resume_state['global_step']
+        start_step = resume_state['step']
+        # Under DDP only rank 0's partial epoch sums were saved.
+        epoch_stats = resume_state['epoch_stats'] if rank == 0 else (0, 0, 0)
+        restore_rng_state(resume_state['rng'])
+        if hard_sampler is not None and resume_state.get('hard_sampler') is not None:
+            hard_sampler.load_state_dict(resume_state['hard_sampler'])
+        if resume_state['stopped']:
+            print("Checkpoint is from a run that already stopped early")
+            start_epoch = args.epochs
     
-    for epoch in range(args.epochs):
+    def compute_loss(outputs, labels, soft_targets):
+        if soft_targets is None:
+            return train_criterion(outputs, labels)
+        return distillation_loss(outputs, soft_targets, labels, train_criterion, args.distill_temperature, args.distill_alpha)
+    
+    def checkpoint(epoch, step, epoch_stats, stopped=False):
+        if rank != 0:
+            return
+        save_checkpoint(
+            checkpoint_path,
+            seed=seed,
+            epoch=epoch,
+            step=step,
+            global_step=global_step,
+            epoch_stats=epoch_stats,
+            model=model.state_dict(),
+            optimizer=optimizer.state_dict(),
+            scheduler=scheduler.state_dict() if scheduler is not None else None,
+            scaler=scaler.state_dict(),
+            hard_sampler=hard_sampler.state_dict() if hard_sampler is not None else None,
+            best_val_acc=best_val_acc,
+            best_sampled_acc=best_sampled_acc,
+            patience_counter=patience_counter,
+            stopped=stopped,
+        )
+    
+    def run_validation(loader):
+        """(correct, total) over loader, summed across ranks."""
+        model.eval()
+        val_correct = 0
+        val_total = 0
+        with torch.no_grad():
+            for inputs, labels in loader:
+                inputs, labels = inputs.to(device), labels.to(device)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_autocast):
+                    outputs = forward_model(inputs)
+                _, predicted = torch.max(outputs.data, 1)
+                val_total += labels.size(0)
+                val_correct += (predicted == labels).sum().item()
+        if distributed:
+            val_correct, val_total = all_reduce_sum(val_correct, val_total)
         model.train()
-        total_loss = 0
-        correct = 0
-        total = 0
+        return val_correct, val_total
+    
+    def validate(epoch, header, epochs_done):
+        """Validate, save a new best and update patience; returns True when training should stop.
+        
+        With --val-sample, patience follows the sampled accuracy (or a confirmed new best) and
+        the full split is only run when the sample beats the best full-split accuracy so far.
+        """
+        nonlocal best_val_acc, best_sampled_acc, patience_counter, best_qat_state, target_reached
+        val_acc = None
+        if val_sample_loader is not None:
+            val_correct, val_total = run_validation(val_sample_loader)
+            sampled_acc = 100 * val_correct / val_total
+            low, high = wilson_interval(val_correct, val_total)
+            print(f"{header} | Val (sample of {val_total}): {sampled_acc:.2f}% [95% CI {low:.2f}-{high:.2f}]")
+            improved = sampled_acc > best_sampled_acc
+            best_sampled_acc = max(best_sampled_acc, sampled_acc)
+            if sampled_acc > best_val_acc:
+                val_correct, val_total = run_validation(val_loader)
+                val_acc = 100 * val_correct / val_total
+                print(f"  Full validation: {val_acc:.2f}%")
+        else:
+            val_correct, val_total = run_validation(val_loader)
+            val_acc = 100 * val_correct / val_total
+            print(f"{header} | Val: {val_acc:.2f}%")
+            improved = val_acc > best_val_acc
+        
+        if args.target_acc and target_reached is None and val_acc is not None and val_acc >= args.target_acc:
+            target_reached = (epochs_done, samples_seen, time.time() - train_start)
+        if val_acc is not None and val_acc > best_val_acc:
+            best_val_acc = val_acc
+            improved = True
+            if args.qat:
+                best_qat_state = copy.deepcopy(model.state_dict())
+            if rank == 0 and args.qat:
+                torch.save(qat_float_state_dict(model), args.model_out)
+            elif rank == 0:
+                model.to("cpu")
+                torch.save(model.state_dict(), args.model_out)
+                model.to(device)
+            print(f"  → Best model saved! (Val: {val_acc:.2f}%)")
+        if improved:
+            patience_counter = 0
+            return False
+        patience_counter += 1
+        min_epochs_before_stop = 3 if args.finetune else 20
+        return patience_counter >= args.patience and epoch >= min_epochs_before_stop
+    
+    train_start = time.time()
+    for epoch in range(start_epoch, args.epochs):
+        model.train()
+        stop = False
+        total_loss, correct, total = epoch_stats
+        epoch_stats = (0, 0, 0)
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+        if hard_sampler is not None and epoch > 0:
+            print(f"  Hard-example sampling: hardest 10% of rows get {hard_sampler.hard_share():.0%} of this epoch's draws")
+        # After a mid-epoch resume, skip the batches that were already trained on.
+        batches = itertools.islice(train_loader, start_step, None) if start_step else train_loader
         
-        for inputs, labels in train_loader:
+        timer.start()
+        for step, (inputs, labels, *soft_targets) in enumerate(batches, start=start_step + 1):
+            timer.mark('data')
             inputs, labels = inputs.to(device), labels.to(device)
+            soft_targets = soft_targets[0].to(device) if soft_targets else None
+            timer.mark('h2d')
+            if args.augment:
+                inputs = augment_ids(inputs)
+                timer.mark('augment')
             
-            # Mixup (applied on logits level for ensemble compatibility)
-            if args.mixup and random.random() < 0.5:
-                # Get outputs first
-                outputs = model(inputs)
-                # Create mixed labels
-                lam = np.random.beta(0.2, 0.2)
-                batch_size = inputs.size(0)
-                index = torch.randperm(batch_size).to(device)
-                y_a, y_b = labels, labels[index]
-                loss = lam * criterion(outputs, y_a) + (1 - lam) * criterion(outputs, y_b)
-            else:
-                outputs = model(inputs)
-                loss = criterion(outputs, labels)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_autocast):
+                # Mixup (applied on logits level for ensemble compatibility)
+                if args.mixup and random.random() < 0.5:
+                    # Get outputs first
+                    outputs = forward_model(inputs)
+                    # Create mixed labels
+                    lam = np.random.beta(0.2, 0.2)
+                    batch_size = inputs.size(0)
+                    index = torch.randperm(batch_size).to(device)
+                    y_a, y_b = labels, labels[index]
+                    if soft_targets is not None:
+                        loss = lam * compute_loss(outputs, y_a, soft_targets) + (1 - lam) * compute_loss(outputs, y_b, soft_targets[index])
+                    else:
+                        loss = lam * train_criterion(outputs, y_a) + (1 - lam) * train_criterion(outputs, y_b)
+                else:
+                    outputs = forward_model(inputs)
+                    loss = compute_loss(outputs, labels, soft_targets)
+            if hard_sampler is not None:
+                # Plain cross-entropy as the difficulty signal: label smoothing / mixup would put a floor under it.
+                rows = hard_sampler.batch_rows(step - 1)
+                row_losses = nn.functional.cross_entropy(outputs.detach().float(), labels, reduction='none')
+                hard_sampler.update(rows, row_losses.cpu())
+                loss = (loss * hard_sampler.importance_weights(rows).to(device)).mean()
+            timer.mark('forward')
             
             optimizer.zero_grad()
-            loss.backward()
+            scaler.scale(loss).backward()
+            timer.mark('backward')
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
+            timer.mark('optimizer')
             
             total_loss += loss.item()
             _, predicted = torch.max(outputs.data, 1)
             total += labels.size(0)
             correct += (predicted == labels).sum().item()
+            timer.mark('metrics')
+            global_step += 1
+            samples_seen += labels.size(0) * world_size
+            if args.checkpoint_every and global_step % args.checkpoint_every == 0:
+                checkpoint(epoch, step, (total_loss, correct, total))
+                timer.mark('checkpoint')
+            timer.end_step(epoch, global_step, labels.size(0))
+            if args.val_every_steps and global_step % args.val_every_steps == 0:
+                stop = validate(epoch, f"  [{epoch+1}] step {step}", epoch + step / len(train_loader))
+                if stop:
+                    break
+                timer.start()
         
+        if stop:
+            checkpoint(epoch, step, (total_loss, correct, total), stopped=True)
+            print(f"Early stopping at epoch {epoch+1}, step {step}")
+            break
+        start_step = 0
+        if distributed:
+            total_loss, correct, total = all_reduce_sum(total_loss / world_size, correct, total)
         train_acc = 100 * correct / total
         
-        # Validation
-        model.eval()
-        val_correct = 0
-        val_total = 0
-        with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = model(inputs)
-                _, predicted = torch.max(outputs.data, 1)
-                val_total += labels.size(0)
-                val_correct += (predicted == labels).sum().item()
-        
-        val_acc = 100 * val_correct / val_total
+        # With --val-every-steps the last step may have just validated.
+        if args.val_every_steps and global_step % args.val_every_steps == 0:
+            print(f"Epoch {epoch+1}/{args.epochs} | Loss: {total_loss/len(train_loader):.4f} | Train: {train_acc:.2f}%")
+        else:
+            stop = validate(epoch, f"Epoch {epoch+1}/{args.epochs} | Loss: {total_loss/len(train_loader):.4f} | Train: {train_acc:.2f}%", epoch + 1)
         if scheduler is not None:
             scheduler.step()
-        
-        print(f"Epoch {epoch+1}/{args.epochs} | Loss: {total_loss/len(train_loader):.4f} | Train: {train_acc:.2f}% | Val: {val_acc:.2f}%")
-        
-        if val_acc > best_val_acc:
-            best_val_acc = val_acc
-            patience_counter = 0
-            model.to("cpu")
-            torch.save(model.state_dict(), args.model_out)
-            model.to(device)
-            print(f"  → Best model saved! (Val: {val_acc:.2f}%)")
-        else:
-            patience_counter += 1
-            min_epochs_before_stop = 3 if args.finetune else 20
-            if patience_counter >= args.patience and epoch >= min_epochs_before_stop:
-                print(f"Early stopping at epoch {epoch+1}")
-                break
+        checkpoint(epoch + 1, 0, (0, 0, 0), stopped=stop)
+        if stop:
+            print(f"Early stopping at epoch {epoch+1}")
+            break
     
     print(f"\nBest validation accuracy: {best_val_acc:.2f}%")
     print(f"Model saved to {args.model_out}")
+    if args.target_acc:
+        sampling = "hard-example" if hard_sampler is not None else "uniform"
+        if target_reached is None:
+            print(f"Target {args.target_acc:.2f}% not reached ({sampling} sampling)")
+        else:
+            epochs_done, samples, seconds = target_reached
+            print(f"Target {args.target_acc:.2f}% reached after {epochs_done:.2f} epochs, {samples:,} samples, "
+                  f"{seconds:.0f}s ({sampling} sampling{', this run only' if resume_state is not None else ''})")
+    
+    timer.close()
+    if step_log and rank == 0:
+        print()
+        summarize(read_step_log(step_log))
+        print(f"Per-step log: {step_log} (python instrument.py {step_log})")
+    
+    if args.distill_from and rank == 0:
+        student, _ = build_model(args)
+        student.load_state_dict(load_state_dict_file(args.model_out))
+        report_distillation(student.to(device), teacher, val_dataset, teacher_logits, device)
+    if args.qat and rank == 0 and os.path.exists(args.model_out):
+        if best_qat_state is not None:
+            model.load_state_dict(best_qat_state)
+        report_qat(args, model, val_dataset)
+    return best_val_acc
 
-if __name__ == "__main__":
+def ddp_worker(rank, world_size, args, port, baseline):
+    """Entry point of one --ddp-cpu process (torch.multiprocessing.spawn)."""
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    torch.set_num_threads(max((os.cpu_count() or world_size) // world_size, 1))
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+    try:
+        train(args, rank, world_size, baseline)
+    finally:
+        dist.destroy_process_group()
+
+def train_ddp_cpu(args):
+    """--ddp-cpu N: N gloo processes on this host, each with cpu_count / N intra-op threads."""
+    world_size = args.ddp_cpu
+    threads = max((os.cpu_count() or world_size) // world_size, 1)
+    # Single-process throughput at the same thread count, for the scaling report.
+    torch.set_num_threads(threads)
+    model, _ = build_model(args)
+    inputs, labels = synthetic_batch(args.batch_size)
+    baseline = measure_ddp_samples_per_sec(model, inputs, labels)
+    del model
+    # Every rank must derive the same split and shard permutations from one seed.
+    if args.seed is None:
+        args.seed = random.randrange(2**31)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    mp.spawn(ddp_worker, args=(world_size, args, port, baseline), nprocs=world_size)
+
+def build_arg_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data', default='training_data.csv')
+    parser.add_argument('--data', default='training_data.csv', help=f"Training CSV, or a pre-tokenized {TOKENIZED_SUFFIX} file")
     parser.add_argument('--epochs', type=int, default=50)
     parser.add_argument('--batch_size', type=int, default=512)
     parser.add_argument('--lr', type=float, default=0.001)
@@ -578,7 +1783,44 @@ if __name__ == "__main__":
     parser.add_argument('--model_v2', action='store_true', help="Use enhanced CNN")
     parser.add_argument('--transformer', action='store_true', help="Use Transformer")
     parser.add_argument('--ensemble', action='store_true', help="Use CNN+Transformer ensemble")
+    parser.add_argument('--hidden-dim', type=int, default=384, help="--model_v2 conv width")
+    parser.add_argument('--embedding-dim', type=int, default=128, help="--model_v2 embedding size")
+    parser.add_argument('--d-model', type=int, default=128, help="--transformer model width")
+    parser.add_argument('--nhead', type=int, default=8, help="--transformer attention heads")
+    parser.add_argument('--num-layers', type=int, default=4, help="--transformer encoder layers")
     parser.add_argument('--augment', action='store_true', help="Enable data augmentation")
     parser.add_argument('--mixup', action='store_true', help="Enable mixup training")
-    args = parser.parse_args()
-    train(args)
+    parser.add_argument('--token-cache-dir', default='.token_cache', help="Where tokenized copies of --data CSVs are cached by content hash. Empty string disables the cache.")
+    parser.add_argument('--fast', action='store_true', help="torch.compile + bfloat16 autocast on CPU / AMP on CUDA (falls back to eager if compile fails)")
+    parser.add_argument('--qat', action='store_true', help="Quantization-aware fine-tuning of --model_in (int8 fake-quant); saves a float checkpoint for export.py --quantize int8")
+    parser.add_argument('--fused-attention', action='store_true', help="QAT only (--qat with --transformer / --ensemble): run the traceable attention through scaled_dot_product_attention; same weights, export still traces the basic ops")
+    parser.add_argument('--head-only', action='store_true', help="Fine-tune only the fc head(s) of --model_in on backbone features computed once and cached in --token-cache-dir")
+    parser.add_argument('--distill-from', default=None, help="Train a small --student on the soft logits of this EnsembleModel checkpoint")
+    parser.add_argument('--student', choices=['v1', 'v2'], default='v1', help="Student for --distill-from: v1 = LayoutClassifier, v2 = LayoutClassifierV2")
+    parser.add_argument('--distill-temperature', type=float, default=4.0, help="Softmax temperature for --distill-from")
+    parser.add_argument('--distill-alpha', type=float, default=0.7, help="Weight of the soft (teacher) loss vs the hard-label loss")
+    parser.add_argument('--ddp-cpu', type=int, default=0, metavar='N', help="Data-parallel training in N CPU processes (gloo); --batch_size is per process")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the train/val split, batch order and --stream generation (random if unset)")
+    parser.add_argument('--checkpoint', default=None, help="Full training-state checkpoint path (default: <model_out>.ckpt)")
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help="Also checkpoint every N training steps (0: only at epoch ends)")
+    parser.add_argument('--resume', action='store_true', help="Continue from --checkpoint if it exists")
+    parser.add_argument('--val-every-steps', type=int, default=0, help="Also validate every N training steps; --patience then counts validations instead of epochs")
+    parser.add_argument('--val-sample', type=int, default=0, metavar='N', help="Validate on a fixed stratified sample of N rows (with a 95%% CI); the full split runs only for suspected new bests")
+    parser.add_argument('--hard-examples', action='store_true', help="Oversample high-loss training rows (per-row loss EMA) with importance-weighted loss")
+    parser.add_argument('--hard-uniform', type=float, default=0.3, help="Share of --hard-examples draws that stay uniform, so easy rows are revisited")
+    parser.add_argument('--target-acc', type=float, default=None, help="Report the epochs / samples / time until full validation first reaches this accuracy (%%)")
+    parser.add_argument('--step-log', default=None, help="Append per-step phase timings (data wait, H2D, fwd, bwd, optimizer), samples/s and peak memory to this JSONL file; syncs the device every phase")
+    parser.add_argument('--profile-steps', type=int, default=0, help="Record a torch.profiler trace of N training steps to <model_out>.trace.json")
+    parser.add_argument('--profile-start', type=int, default=10, help="Global step after which the --profile-steps window starts")
+    parser.add_argument('--stream', action='store_true', help="Generate samples on the fly in DataLoader workers instead of reading --data")
+    parser.add_argument('--stream-samples', type=int, default=1_000_000, help="Samples per epoch with --stream")
+    parser.add_argument('--stream-val-samples', type=int, default=50_000, help="Size of the fixed generated validation set with --stream")
+    generate_data.add_source_args(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    if args.ddp_cpu > 1:
+        train_ddp_cpu(args)
+    else:
+        train(args)
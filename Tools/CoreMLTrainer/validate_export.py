@@ -24,16 +24,17 @@ def softmax_np(x: np.ndarray) -> np.ndarray:
 
 
 def load_torch_model(args) -> torch.nn.Module:
+    state_dict = torch.load(args.model_in, weights_only=True)
     if args.ensemble:
         model = EnsembleModel(traceable_transformer=True)
     elif args.transformer:
         model = LayoutTransformer(traceable=True)
     elif args.model_v2:
-        model = LayoutClassifierV2()
+        model = LayoutClassifierV2(**LayoutClassifierV2.config_from_state_dict(state_dict))
     else:
         model = LayoutClassifier()
 
-    model.load_state_dict(torch.load(args.model_in, weights_only=True))
+    model.load_state_dict(state_dict)
     model.eval()
     return model
 
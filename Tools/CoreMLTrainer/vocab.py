@@ -0,0 +1,48 @@
+"""Tokenizer constants shared by generate_data.py, train.py and the tokenized dataset format.
+
+Kept free of torch so data generation does not need it.
+"""
+import hashlib
+
+import numpy as np
+
+# Constants
+INPUT_LENGTH = 20
+ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890 -=[]\\;',./`!@#$%^&*()_+{}|:\"<>?~"
+ALPHABET += "абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+ALPHABET += "אבגדהוזחטיכלמנסעפצקרשתךםןףץ"
+CHAR_TO_IDX = {c: i+1 for i, c in enumerate(ALPHABET)}
+VOCAB_SIZE = len(ALPHABET) + 1
+
+CLASSES = [
+    'ru', 'en', 'he',
+    'ru_from_en', 'he_from_en',
+    'en_from_ru', 'en_from_he',
+    'he_from_ru', 'ru_from_he'
+]
+CLASS_TO_IDX = {c: i for i, c in enumerate(CLASSES)}
+
+# Code point -> token id lookup table for vectorized tokenization.
+_CODEPOINT_TO_IDX = np.zeros(max(ord(c) for c in ALPHABET) + 1, dtype=np.int64)
+for _c, _i in CHAR_TO_IDX.items():
+    _CODEPOINT_TO_IDX[ord(_c)] = _i
+
+def encode_texts(texts):
+    """Tokenize and pad/truncate strings to an int64 [N, INPUT_LENGTH] array.
+
+    Produces the same ids as LayoutDataset.__getitem__, but for a whole list at once:
+    strings are packed into a fixed-width UTF-32 array and mapped through a lookup table.
+    """
+    packed = np.asarray(texts, dtype=f"<U{INPUT_LENGTH}")
+    cps = packed.view(np.uint32).reshape(len(packed), INPUT_LENGTH)
+    size = len(_CODEPOINT_TO_IDX)
+    return np.where(cps < size, _CODEPOINT_TO_IDX[np.minimum(cps, size - 1)], 0)
+
+def decode_ids(ids):
+    """Inverse of encode_texts for one row (unknown chars and padding are dropped)."""
+    return "".join(ALPHABET[i - 1] for i in ids if i > 0)
+
+def tokenizer_hash():
+    """Fingerprint of everything that defines token ids and labels."""
+    spec = f"{INPUT_LENGTH}\n{ALPHABET}\n{','.join(CLASSES)}"
+    return hashlib.sha256(spec.encode('utf-8')).hexdigest()
@@ -75,6 +75,7 @@ Commands:
 Environment:
   OMFK_ULTRA=1           Enable ultra training mode
   OMFK_FORCE_RETRAIN=1   Force model retraining
+  OMFK_HE_QWERTY_HEAD_ONLY=1  he_qwerty fine-tune trains only the fc heads on cached features
 EOF
 }
 
@@ -322,6 +323,7 @@ cmd_train_coreml() {
   local he_batch="${OMFK_HE_QWERTY_BATCH_SIZE:-512}"
   local he_lr="${OMFK_HE_QWERTY_LR:-0.0001}"
   local he_patience="${OMFK_HE_QWERTY_PATIENCE:-5}"
+  local he_head_only="${OMFK_HE_QWERTY_HEAD_ONLY:-0}"
 
   local max_corpus_words="${OMFK_MAX_CORPUS_WORDS:-2000000}"
   local corpus_sample_mode="${OMFK_CORPUS_SAMPLE_MODE:-reservoir}"
@@ -344,7 +346,7 @@ cmd_train_coreml() {
   say "Config:"
   say "  base_dataset=${base_dataset}"
   say "  base_samples=${base_samples} base_epochs=${base_epochs} base_batch=${base_batch} base_lr=${base_lr} base_patience=${base_patience}"
-  say "  he_qwerty_samples=${he_samples} he_epochs=${he_epochs} he_batch=${he_batch} he_lr=${he_lr} he_patience=${he_patience}"
+  say "  he_qwerty_samples=${he_samples} he_epochs=${he_epochs} he_batch=${he_batch} he_lr=${he_lr} he_patience=${he_patience} he_head_only=${he_head_only}"
   say "  max_corpus_words=${max_corpus_words} corpus_sample_mode=${corpus_sample_mode}"
   say "  force_retrain=${force_retrain} force_regen_data=${force_regen_data} skip_he_qwerty_finetune=${skip_finetune}"
 
@@ -403,6 +405,11 @@ PY
   )
 
   local model_for_export="${base_model}"
+  # Head-only: frozen backbone, features cached once, only the fc heads train (minutes instead of hours).
+  local he_mode_flags="--augment"
+  if [[ "${he_head_only}" == "1" ]]; then
+    he_mode_flags="--head-only"
+  fi
   if [[ "${skip_finetune}" != "1" ]]; then
     (cd "${COREML_DIR}" && \
       info "--- Fine-tuning for Hebrew QWERTY sofits (Ticket 23) ---" && \
@@ -417,7 +424,7 @@ PY
         --focus-layout "he_qwerty" && \
       python3 train.py \
         --epochs "${he_epochs}" --batch_size "${he_batch}" --lr "${he_lr}" --patience "${he_patience}" \
-        --ensemble --finetune --model_in "model_production.pth" --augment \
+        --ensemble --finetune --model_in "model_production.pth" ${he_mode_flags} \
         --data "training_data_he_qwerty.csv" --model_out "model_production_he_qwerty.pth" \
     )
     model_for_export="${finetuned_model}"